@@ -0,0 +1,343 @@
+import botocore.exceptions
+import botocore.hooks
+import collections
+import copy
+import datetime
+import functools
+import hashlib
+import io
+import threading
+import time
+import types
+
+
+ACCOUNT_ID = '111111111111'
+
+
+class InvalidParameterException(Exception):
+    pass
+
+
+# Token bucket per operation. When the bucket is empty the call waits for the next token and counts as throttled,
+# standing in for the client side retries botocore does on a real ThrottlingException
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = collections.defaultdict(lambda: float(rate))
+        self.updated = collections.defaultdict(time.monotonic)
+        self.lock = threading.Lock()
+
+    def acquire(self, operation):
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens[operation] = min(self.rate, self.tokens[operation] + (now - self.updated[operation]) * self.rate)
+            self.updated[operation] = now
+            self.tokens[operation] -= 1
+            missing = -self.tokens[operation]
+        if missing <= 0:
+            return 0.0
+        delay = missing / self.rate
+        time.sleep(delay)
+        return delay
+
+
+# In-process ECS, EventBridge and STS state shared by every fake client
+class FakeAws:
+    def __init__(self, region='us-east-1', latency=0.0, rate_limit=0):
+        self.region = region
+        self.latency = latency
+        self.limiter = RateLimiter(rate_limit)
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self.lock = threading.RLock()
+        self.task_definitions = {}
+        self.families = collections.defaultdict(list)
+        self.tags = {}
+        self.services = {}
+        self.tasks = {}
+        self.rules = collections.defaultdict(list)
+        self.objects = {}
+        self.image_digests = {}
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.throttles.clear()
+
+    # Returns whether the call was throttled
+    def record(self, service, operation):
+        name = service + ':' + operation
+        throttled = bool(self.limiter.acquire(name))
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] += 1
+            if throttled:
+                self.throttles[name] += 1
+        return throttled
+
+    def client(self, service, *args, **kwargs):
+        return {
+            'ecs': FakeEcs,
+            'events': FakeEvents,
+            'sts': FakeSts,
+            's3': FakeS3,
+            'ecr': FakeEcr,
+        }[service](self)
+
+    def task_definition_arn(self, family, revision):
+        return 'arn:aws:ecs:%s:%s:task-definition/%s:%d' % (self.region, ACCOUNT_ID, family, revision)
+
+    def add_task_definition(self, family, container_definitions, tags=None, **fields):
+        with self.lock:
+            revision = len(self.families[family]) + 1
+            arn = self.task_definition_arn(family, revision)
+            task_definition = dict(fields, family=family, revision=revision, taskDefinitionArn=arn,
+                                   containerDefinitions=copy.deepcopy(container_definitions), status='ACTIVE')
+            self.task_definitions[arn] = task_definition
+            self.families[family].append(arn)
+            self.tags[arn] = list(tags or [])
+            return task_definition
+
+    def add_service(self, cluster_name, service_name, task_definition_arn, desired_count=2):
+        cluster_arn = 'arn:aws:ecs:%s:%s:cluster/%s' % (self.region, ACCOUNT_ID, cluster_name)
+        service_arn = 'arn:aws:ecs:%s:%s:service/%s/%s' % (self.region, ACCOUNT_ID, cluster_name, service_name)
+        self.services[(cluster_name, service_name)] = {
+            'serviceName': service_name,
+            'serviceArn': service_arn,
+            'clusterArn': cluster_arn,
+            'taskDefinition': task_definition_arn,
+            'desiredCount': desired_count,
+            'runningCount': desired_count,
+        }
+        self.run_tasks(cluster_name, service_name)
+
+    # Rolls the tasks of a service over to its current task definition at once
+    def run_tasks(self, cluster_name, service_name):
+        service = self.services[(cluster_name, service_name)]
+        self.tasks[(cluster_name, service_name)] = [
+            {
+                'taskArn': '%s/task/%s/%s-%d' % (service['clusterArn'], cluster_name, service_name, i),
+                'taskDefinitionArn': service['taskDefinition'],
+                'lastStatus': 'RUNNING',
+            }
+            for i in range(service['desiredCount'])
+        ]
+
+    def add_rule_target(self, rule_name, target_id, task_definition_arn):
+        self.rules[rule_name].append({
+            'Id': target_id,
+            'Arn': 'arn:aws:ecs:%s:%s:cluster/scheduled' % (self.region, ACCOUNT_ID),
+            'RoleArn': 'arn:aws:iam::%s:role/events-ecs' % ACCOUNT_ID,
+            'EcsParameters': {'TaskDefinitionArn': task_definition_arn, 'TaskCount': 1, 'LaunchType': 'FARGATE'},
+        })
+
+    # Digest of an image tag, every tag has its own digest unless it was pushed again with push_image
+    def image_digest(self, repository, tag):
+        default = 'sha256:' + hashlib.sha256(('%s:%s' % (repository, tag)).encode()).hexdigest()
+        return self.image_digests.get((repository, tag), default)
+
+    # Point tag of repository at the image of another tag, like pushing the same image again under a new tag
+    def push_image(self, repository, tag, same_as_tag):
+        self.image_digests[(repository, tag)] = self.image_digest(repository, same_as_tag)
+
+    def resolve_task_definition(self, name):
+        if name in self.task_definitions:
+            return self.task_definitions[name]
+        family, _, revision = name.rpartition(':')
+        if family and revision.isdigit():
+            return self.task_definitions[self.task_definition_arn(family, int(revision))]
+        return self.task_definitions[self.families[name][-1]]
+
+
+def _ok(**body):
+    body['ResponseMetadata'] = {'HTTPStatusCode': 200}
+    return body
+
+
+# Marks a fake client method as the api operation, recording the call and emitting the same botocore events as a
+# real client so event hooks registered on client.meta.events see it
+def operation(name):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            events = self.meta.events
+            context = {}
+            events.emit('before-call.%s.%s' % (self.service, name), model=None, params=kwargs, context=context)
+            if self.aws.record(self.service, name):
+                throttle = {'Error': {'Code': 'ThrottlingException'}}
+                events.emit('needs-retry.%s.%s' % (self.service, name), response=(None, throttle), attempts=1,
+                            request_dict={'context': context})
+            try:
+                response = method(self, *args, **kwargs)
+            except Exception as e:
+                events.emit('after-call-error.%s.%s' % (self.service, name), exception=e, context=context)
+                raise
+            events.emit('after-call.%s.%s' % (self.service, name), http_response=None, parsed=response, model=None,
+                        context=context)
+            return response
+        return wrapper
+    return decorator
+
+
+class FakeClient:
+    service = None
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.meta = types.SimpleNamespace(events=botocore.hooks.HierarchicalEmitter(), region_name=aws.region)
+
+
+class FakeSts(FakeClient):
+    service = 'sts'
+
+    @operation('AssumeRole')
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds=3600):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+        return _ok(Credentials={
+            'AccessKeyId': 'ASIAFAKE',
+            'SecretAccessKey': 'fake',
+            'SessionToken': 'fake',
+            'Expiration': expiration,
+        })
+
+
+class FakeEcs(FakeClient):
+    service = 'ecs'
+
+    @operation('DescribeServices')
+    def describe_services(self, cluster, services, **kwargs):
+        if len(services) > 10:
+            raise InvalidParameterException('describe_services accepts at most 10 services')
+        found = []
+        failures = []
+        for name in services:
+            key = (cluster.rsplit('/', 1)[-1], name.rsplit('/', 1)[-1])
+            if key in self.aws.services:
+                service = copy.deepcopy(self.aws.services[key])
+                service['deployments'] = [{
+                    'status': 'PRIMARY',
+                    'taskDefinition': service['taskDefinition'],
+                    'desiredCount': service['desiredCount'],
+                    'runningCount': service['runningCount'],
+                    'failedTasks': 0,
+                    'rolloutState': 'COMPLETED',
+                }]
+                found.append(service)
+            else:
+                failures.append({'arn': name, 'reason': 'MISSING'})
+        return _ok(services=found, failures=failures)
+
+    @operation('DescribeTaskDefinition')
+    def describe_task_definition(self, taskDefinition, include=None):
+        task_definition = self.aws.resolve_task_definition(taskDefinition)
+        response = _ok(taskDefinition=copy.deepcopy(task_definition))
+        if include and 'TAGS' in include:
+            response['tags'] = copy.deepcopy(self.aws.tags[task_definition['taskDefinitionArn']])
+        return response
+
+    @operation('ListTaskDefinitions')
+    def list_task_definitions(self, familyPrefix=None, status='ACTIVE', sort='ASC', maxResults=100, nextToken=None):
+        arns = [arn for family, family_arns in self.aws.families.items()
+                if familyPrefix is None or family.startswith(familyPrefix) for arn in family_arns]
+        if sort == 'DESC':
+            arns.reverse()
+        start = int(nextToken or 0)
+        response = _ok(taskDefinitionArns=arns[start:start + maxResults])
+        if start + maxResults < len(arns):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    @operation('RegisterTaskDefinition')
+    def register_task_definition(self, family, containerDefinitions, tags=None, **fields):
+        task_definition = self.aws.add_task_definition(family, containerDefinitions, tags, **fields)
+        return _ok(taskDefinition=copy.deepcopy(task_definition))
+
+    @operation('UpdateService')
+    def update_service(self, cluster, service, taskDefinition, **kwargs):
+        key = (cluster.rsplit('/', 1)[-1], service.rsplit('/', 1)[-1])
+        with self.aws.lock:
+            self.aws.services[key]['taskDefinition'] = self.aws.resolve_task_definition(taskDefinition)[
+                'taskDefinitionArn']
+            self.aws.run_tasks(*key)
+            return _ok(service=copy.deepcopy(self.aws.services[key]))
+
+    @operation('ListTasks')
+    def list_tasks(self, cluster, serviceName, maxResults=100, desiredStatus='RUNNING', nextToken=None, **kwargs):
+        tasks = self.aws.tasks.get((cluster.rsplit('/', 1)[-1], serviceName), [])
+        start = int(nextToken or 0)
+        response = _ok(taskArns=[task['taskArn'] for task in tasks[start:start + maxResults]])
+        if start + maxResults < len(tasks):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    @operation('DescribeTasks')
+    def describe_tasks(self, cluster, tasks, **kwargs):
+        if len(tasks) > 100:
+            raise InvalidParameterException('describe_tasks accepts at most 100 tasks')
+        wanted = set(tasks)
+        found = [copy.deepcopy(task) for service_tasks in self.aws.tasks.values()
+                 for task in service_tasks if task['taskArn'] in wanted]
+        return _ok(tasks=found, failures=[])
+
+
+class FakeEvents(FakeClient):
+    service = 'events'
+
+    @operation('ListTargetsByRule')
+    def list_targets_by_rule(self, Rule, Limit=100, NextToken=None):
+        targets = self.aws.rules[Rule]
+        start = int(NextToken or 0)
+        response = _ok(Targets=copy.deepcopy(targets[start:start + Limit]))
+        if start + Limit < len(targets):
+            response['NextToken'] = str(start + Limit)
+        return response
+
+    @operation('PutTargets')
+    def put_targets(self, Rule, Targets):
+        if len(Targets) > 10:
+            raise InvalidParameterException('put_targets accepts at most 10 targets')
+        with self.aws.lock:
+            existing = {target['Id']: i for i, target in enumerate(self.aws.rules[Rule])}
+            for target in Targets:
+                if target['Id'] in existing:
+                    self.aws.rules[Rule][existing[target['Id']]] = copy.deepcopy(target)
+                else:
+                    self.aws.rules[Rule].append(copy.deepcopy(target))
+        return _ok(FailedEntryCount=0, FailedEntries=[])
+
+
+class FakeS3(FakeClient):
+    service = 's3'
+
+    @operation('PutObject')
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.aws.objects[(Bucket, Key)] = bytes(Body)
+        return _ok()
+
+    @operation('GetObject')
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.aws.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return _ok(Body=io.BytesIO(self.aws.objects[(Bucket, Key)]))
+
+    @operation('CopyObject')
+    def copy_object(self, Bucket, Key, CopySource):
+        source_bucket, _, source_key = CopySource.partition('/')
+        self.aws.objects[(Bucket, Key)] = self.aws.objects[(source_bucket, source_key)]
+        return _ok()
+
+
+class FakeEcr(FakeClient):
+    service = 'ecr'
+
+    @operation('BatchGetImage')
+    def batch_get_image(self, registryId, repositoryName, imageIds, acceptedMediaTypes=None):
+        if len(imageIds) > 100:
+            raise InvalidParameterException('batch_get_image accepts at most 100 image ids')
+        images = [{'imageId': {'imageTag': image_id['imageTag'],
+                               'imageDigest': self.aws.image_digest(repositoryName, image_id['imageTag'])},
+                   'registryId': registryId, 'repositoryName': repositoryName}
+                  for image_id in imageIds]
+        return _ok(images=images, failures=[])
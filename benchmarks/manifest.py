@@ -0,0 +1,97 @@
+import random
+
+
+REGISTRY = '111111111111.dkr.ecr.us-east-1.amazonaws.com'
+SERVICES_PER_CLUSTER = 50
+
+
+def environment(size):
+    return [{'name': 'SETTING_%d' % i, 'value': 'value-%d' % i} for i in range(size)]
+
+
+# Application container plus the sidecars most services run next to it
+def container_definitions(service, tag, environment_size):
+    return [
+        {
+            'name': 'envoy',
+            'image': REGISTRY + '/envoy:v1.25',
+            'essential': True,
+            'environment': environment(4),
+        },
+        {
+            'name': service,
+            'image': '%s/%s:%s' % (REGISTRY, service, tag),
+            'essential': True,
+            'portMappings': [{'containerPort': 8080, 'protocol': 'tcp'}],
+            'environment': environment(environment_size),
+        },
+        {
+            'name': 'log-router',
+            'image': REGISTRY + '/fluent-bit:2.1',
+            'essential': False,
+            'firelensConfiguration': {'type': 'fluentbit'},
+        },
+    ]
+
+
+def task_definition_fields():
+    return {
+        'taskRoleArn': 'arn:aws:iam::111111111111:role/task-role',
+        'executionRoleArn': 'arn:aws:iam::111111111111:role/execution-role',
+        'networkMode': 'awsvpc',
+        'volumes': [],
+        'placementConstraints': [],
+        'requiresCompatibilities': ['FARGATE'],
+        'cpu': '512',
+        'memory': '1024',
+    }
+
+
+# Spread entries over accounts and regions round robin. fake_aws is not partitioned by account or region, only the
+# clients and chunks the functions use are
+def placement(i, accounts, regions):
+    fields = {}
+    if accounts > 1:
+        fields['account'] = '%012d' % (111111111111 + i % accounts)
+    if regions:
+        fields['region'] = regions[i % len(regions)]
+    return fields
+
+
+# Populate fake_aws with services and scheduled tasks running tag 1.0.0 and return a deployment.yaml equivalent
+# where a changed share of them moves to tag 2.0.0. For a retagged share of the services 2.0.0 is the same image as
+# 1.0.0 pushed again
+def build(fake_aws, services, tasks, changed=0.5, desired_count=2, environment_size=20, targets_per_rule=1, seed=0,
+          accounts=1, regions=None, retagged=0.0):
+    rng = random.Random(seed)
+    manifest = {'release': '2.0.0', 'tasks': [], 'services': []}
+    for i in range(services):
+        service = 'service-%04d' % i
+        cluster = 'cluster-%02d' % (i // SERVICES_PER_CLUSTER)
+        task_definition = fake_aws.add_task_definition(service, container_definitions(service, '1.0.0', environment_size),
+                                                       **task_definition_fields())
+        fake_aws.add_service(cluster, service + '-svc', task_definition['taskDefinitionArn'], desired_count)
+        tag = '2.0.0' if rng.random() < changed else '1.0.0'
+        if rng.random() < retagged:
+            fake_aws.push_image(service, '2.0.0', '1.0.0')
+        manifest['services'].append({
+            'service': service,
+            'clusterName': cluster,
+            'serviceName': service + '-svc',
+            'image': '%s/%s:%s' % (REGISTRY, service, tag),
+            **placement(i, accounts, regions),
+        })
+    for i in range(tasks):
+        task = 'task-%04d' % i
+        task_definition = fake_aws.add_task_definition(task, container_definitions(task, '1.0.0', environment_size),
+                                                       **task_definition_fields())
+        for target in range(targets_per_rule):
+            fake_aws.add_rule_target(task + '-rule', 'target-%d' % target, task_definition['taskDefinitionArn'])
+        tag = '2.0.0' if rng.random() < changed else '1.0.0'
+        manifest['tasks'].append({
+            'service': task,
+            'cwRuleName': task + '-rule',
+            'image': '%s/%s:%s' % (REGISTRY, task, tag),
+            **placement(i, accounts, regions),
+        })
+    return manifest
@@ -0,0 +1,198 @@
+"""Offline benchmark of the deployment functions against in-process fake ECS, EventBridge and STS.
+
+Runs the handlers of src/init, src/task, src/deploy and src/validate the way the step function would for synthetic
+releases of increasing size and reports wall time, API calls per operation, throttled calls and peak memory per step.
+
+    python benchmarks/run.py --services 10 100 1000 --latency-ms 20 --rate-limit 20
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src')
+ROLE_ARN = 'arn:aws:iam::111111111111:role/ecs-deployment-role'
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('ACCOUNT_ID', '111111111111')
+os.environ.setdefault('ECS_DEPLOYMENT_ROLE_ARN', ROLE_ARN)
+os.environ.setdefault('LOG_LEVEL', 'error')
+# api calls are still instrumented, only the metric records are kept off the report
+os.environ.setdefault('EMIT_METRICS', 'false')
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+import fake_aws  # noqa: E402
+import manifest  # noqa: E402
+from deploy_common import clients  # noqa: E402
+from deploy_common import payloads  # noqa: E402
+from deploy_common import task_definitions  # noqa: E402
+
+
+def load_handler(name):
+    spec = importlib.util.spec_from_file_location(name + '_lambda', os.path.join(SRC_DIR, name, 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Run invoke once per event and measure the step as a whole
+def measure(aws, step, invoke, events, cold):
+    aws.reset_counters()
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = []
+    for event in events:
+        if cold:
+            clients.clear()
+            task_definitions.clear_cache()
+        results.append(invoke(event, None))
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, {
+        'step': step,
+        'invocations': len(events),
+        'wallSeconds': round(wall, 3),
+        'apiCalls': sum(aws.calls.values()),
+        'throttled': sum(aws.throttles.values()),
+        'peakKiB': peak // 1024,
+        'calls': dict(sorted(aws.calls.items())),
+    }
+
+
+# One release through InitConfig, the per task and per service steps, a rollback of every updated service and the
+# batch entry points. The rollback steps only run without --offload
+def run_release(handlers, size, args):
+    def new_aws():
+        # revision arns of a new fake start over, unlike real ones
+        task_definitions.clear_cache()
+        aws = fake_aws.FakeAws(latency=args.latency_ms / 1000.0, rate_limit=args.rate_limit)
+        release = manifest.build(aws, size, int(size * args.tasks_ratio), args.changed, args.desired_count,
+                                 args.environment_size, args.targets_per_rule, accounts=args.accounts,
+                                 regions=args.regions, retagged=args.retagged)
+        return aws, release
+
+    reports = []
+    aws, release = new_aws()
+    clients.clear()
+    with mock.patch('boto3.client', aws.client), \
+            mock.patch.object(payloads, 'OFFLOAD_PAYLOADS', args.offload), \
+            mock.patch.object(payloads, 'RELEASE_BUCKET', 'benchmark-bucket'):
+        (planned,), report = measure(aws, 'init', handlers['init'].handler, [copy.deepcopy(release)], args.cold)
+        reports.append(report)
+        _, report = measure(aws, 'task', handlers['task'].handler, planned['tasks'] or [], args.cold)
+        reports.append(report)
+        services = [service for wave in planned['waves'] for service in wave]
+        deployed, report = measure(aws, 'deploy', handlers['deploy'].handler, services, args.cold)
+        reports.append(report)
+        # deployed entries as the rollback step receives them when the state machine catches their validation error
+        failed = [dict(copy.deepcopy(event), deploymentError={'Error': 'Exception', 'Cause': 'benchmark'})
+                  for event in deployed if not args.offload and event['deploymentNeeded']]
+        _, report = measure(aws, 'validate', handlers['validate'].handler, deployed, args.cold)
+        reports.append(report)
+        rolled_back, report = measure(aws, 'rollback', handlers['deploy'].rollback_handler, failed, args.cold)
+        reports.append(report)
+        _, report = measure(aws, 'validate-rollback', handlers['validate'].handler, rolled_back, args.cold)
+        reports.append(report)
+
+    aws, release = new_aws()
+    clients.clear()
+    with mock.patch('boto3.client', aws.client):
+        services = copy.deepcopy(release['services'])
+        tasks = copy.deepcopy(release['tasks'])
+        for entry in services + tasks:
+            entry['assumeRole'] = clients.role_in_account(ROLE_ARN, entry.get('account', fake_aws.ACCOUNT_ID))
+        _, report = measure(aws, 'task-batch', handlers['task'].batch_handler, [{'tasks': tasks}], args.cold)
+        reports.append(report)
+        _, report = measure(aws, 'deploy-batch', handlers['deploy'].batch_handler, [{'services': services}],
+                            args.cold)
+        reports.append(report)
+
+    if args.incremental:
+        reports.extend(run_incremental(handlers, new_aws, args))
+    return reports
+
+
+# A release applied in full, then a release where an incremental share of the services moves to tag 3.0.0, planned
+# against the manifest of the first one
+def run_incremental(handlers, new_aws, args):
+    reports = []
+    aws, release = new_aws()
+    clients.clear()
+    with mock.patch('boto3.client', aws.client), \
+            mock.patch.object(payloads, 'RELEASE_BUCKET', 'benchmark-bucket'), \
+            mock.patch.object(handlers['init'], 'INCREMENTAL_RELEASES', True):
+        applied = handlers['init'].handler(copy.deepcopy(release), None)
+        for service in [service for wave in applied['waves'] for service in wave]:
+            handlers['deploy'].handler(service, None)
+        # what the RecordManifest state does once the release succeeded
+        manifest = applied['manifest']
+        aws.client('s3').copy_object(Bucket=manifest['bucket'], Key=manifest['key'], CopySource=manifest['copySource'])
+
+        release['release'] = '3.0.0'
+        for service in release['services'][:int(len(release['services']) * args.incremental)]:
+            service['image'] = service['image'].rsplit(':', 1)[0] + ':3.0.0'
+        (planned,), report = measure(aws, 'init-incremental', handlers['init'].handler, [copy.deepcopy(release)],
+                                     args.cold)
+        reports.append(report)
+        services = [service for wave in planned['waves'] for service in wave]
+        _, report = measure(aws, 'deploy-incremental', handlers['deploy'].handler, services, args.cold)
+        reports.append(report)
+    return reports
+
+
+def print_reports(size, reports):
+    print('\n== %d services ==' % size)
+    print('%-18s %6s %9s %9s %9s %10s' % ('step', 'calls', 'wall s', 'api', 'throttle', 'peak KiB'))
+    for report in reports:
+        print('%-18s %6d %9.3f %9d %9d %10d' % (report['step'], report['invocations'], report['wallSeconds'],
+                                              report['apiCalls'], report['throttled'], report['peakKiB']))
+        for operation, count in report['calls'].items():
+            print('    %-40s %8d' % (operation, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, nargs='+', default=[10, 100, 1000],
+                        help='release sizes to benchmark')
+    parser.add_argument('--tasks-ratio', type=float, default=0.1, help='scheduled tasks per service')
+    parser.add_argument('--targets-per-rule', type=int, default=1, help='ECS targets of every scheduled task rule')
+    parser.add_argument('--accounts', type=int, default=1, help='accounts the entries are spread over')
+    parser.add_argument('--regions', nargs='+', help='regions the entries are spread over')
+    parser.add_argument('--changed', type=float, default=0.5, help='share of services with a new image')
+    parser.add_argument('--retagged', type=float, default=0.0,
+                        help='share of services whose new tag is the current image pushed again')
+    parser.add_argument('--desired-count', type=int, default=2, help='running tasks per service')
+    parser.add_argument('--environment-size', type=int, default=20,
+                        help='environment variables of the application container')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every API call')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='calls per second per operation before calls are throttled, 0 disables throttling')
+    parser.add_argument('--incremental', type=float, default=0.0,
+                        help='also run a release changing this share of the services against the applied manifest')
+    parser.add_argument('--offload', action='store_true',
+                        help='pass the release through S3 chunks instead of the step function state')
+    parser.add_argument('--cold', action='store_true', help='drop cached credentials and clients between invocations')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    handlers = {name: load_handler(name) for name in ('init', 'task', 'deploy', 'validate')}
+    results = {}
+    for size in args.services:
+        reports = run_release(handlers, size, args)
+        results[size] = reports
+        if not args.json:
+            print_reports(size, reports)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
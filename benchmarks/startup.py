@@ -0,0 +1,142 @@
+"""Cold start benchmark of one function per step against the dispatcher function.
+
+A release runs the init, deploy-task, deploy and validate steps. With one function per step every step starts in a
+new execution environment, imports boto3 and the layer and creates its clients. With the dispatcher the first step
+pays for that and the next ones only import their own code and reuse the clients. Every measurement runs in a fresh
+interpreter, no AWS account is needed: clients are created with placeholder credentials and never called.
+
+    python benchmarks/startup.py --repeat 5
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src')
+ROLE_ARN = 'arn:aws:iam::111111111111:role/ecs-deployment-role'
+# step -> clients its first invocation creates, services of the deployment role and of the function's own credentials
+STEPS = [
+    ('init', ['ecs', 'events'], ['sts', 's3']),
+    ('task', ['events', 'ecs'], ['sts', 's3']),
+    ('deploy', ['ecs'], ['sts', 's3']),
+    ('validate', ['ecs'], ['sts', 's3']),
+]
+
+ENVIRONMENT = {
+    'REGION': 'us-east-1',
+    'ACCOUNT_ID': '111111111111',
+    'ECS_DEPLOYMENT_ROLE_ARN': ROLE_ARN,
+    'LOG_LEVEL': 'error',
+    'EMIT_METRICS': 'false',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+}
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Create the clients of a step the way its first invocation would, through the layer
+def create_clients(step):
+    from deploy_common import clients
+    credentials = {'AccessKeyId': 'benchmark', 'SecretAccessKey': 'benchmark', 'SessionToken': 'benchmark',
+                   'Expiration': clients._now() + datetime.timedelta(days=1)}
+    clients._credentials.setdefault(ROLE_ARN, credentials)
+    _, role_services, own_services = next(entry for entry in STEPS if entry[0] == step)
+    for service in role_services:
+        clients.get_client(service, ROLE_ARN, ENVIRONMENT['REGION'])
+    for service in own_services:
+        clients.get_own_client(service)
+
+
+# Runs in the child interpreter, prints the import and client creation time of every step in ms
+def child(mode, steps):
+    sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+    results = []
+    started = time.perf_counter()
+    dispatcher = None
+    if mode == 'dispatcher':
+        dispatcher = load_module('dispatcher_lambda', os.path.join(SRC_DIR, 'dispatcher', 'lambda.py'))
+    for step in steps:
+        if dispatcher is not None:
+            dispatcher.load(step)
+        else:
+            load_module(step + '_lambda', os.path.join(SRC_DIR, step, 'lambda.py'))
+        created = time.perf_counter()
+        create_clients(step)
+        finished = time.perf_counter()
+        results.append({'step': step, 'importMs': (created - started) * 1000, 'clientsMs': (finished - created) * 1000})
+        started = finished
+    print(json.dumps(results))
+
+
+def spawn(mode, steps):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode] + steps,
+                            env=dict(os.environ, **ENVIRONMENT), check=True, stdout=subprocess.PIPE).stdout
+    process_ms = (time.perf_counter() - started) * 1000
+    return json.loads(output), process_ms
+
+
+# One release: a new interpreter per step, or a single interpreter running every step through the dispatcher
+def measure_release(mode):
+    steps = [step for step, _, _ in STEPS]
+    if mode == 'dispatcher':
+        results, process_ms = spawn(mode, steps)
+        return results, process_ms
+    results = []
+    process_ms = 0.0
+    for step in steps:
+        step_results, step_ms = spawn(mode, [step])
+        results.extend(step_results)
+        process_ms += step_ms
+    return results, process_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='releases measured per mode, medians are reported')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1:])
+        return
+
+    report = {}
+    for mode in ('separate', 'dispatcher'):
+        runs = [measure_release(mode) for _ in range(args.repeat)]
+        report[mode] = {
+            'steps': [{'step': step,
+                       'importMs': round(statistics.median(run[0][i]['importMs'] for run in runs), 1),
+                       'clientsMs': round(statistics.median(run[0][i]['clientsMs'] for run in runs), 1)}
+                      for i, (step, _, _) in enumerate(STEPS)],
+            'processMs': round(statistics.median(run[1] for run in runs), 1),
+        }
+        report[mode]['totalMs'] = round(sum(step['importMs'] + step['clientsMs'] for step in report[mode]['steps']), 1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for mode, result in report.items():
+        print('\n== %s ==' % mode)
+        print('%-10s %10s %10s' % ('step', 'import ms', 'clients ms'))
+        for step in result['steps']:
+            print('%-10s %10.1f %10.1f' % (step['step'], step['importMs'], step['clientsMs']))
+        print('%-10s %21.1f' % ('total', result['totalMs']))
+        print('%-10s %21.1f' % ('processes', result['processMs']))
+
+
+if __name__ == '__main__':
+    main()
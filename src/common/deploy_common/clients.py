@@ -0,0 +1,157 @@
+import boto3
+import botocore.config
+import collections
+import datetime
+import logging
+import os
+import threading
+
+from deploy_common import metrics
+
+
+ASSUME_ROLE_DURATION_SECONDS = 1800
+ROLE_SESSION_NAME = "AssumeRoleSession1"
+# Region of the entries that don't set one
+DEFAULT_REGION = os.environ.get('REGION')
+# Credentials are refreshed this long before STS says they expire, so that a
+# client handed out near the end of the window is still valid for a full step
+CREDENTIAL_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Shared by every client. Adaptive retries rate limit the client and absorb ECS and EventBridge throttling inside the
+# invocation instead of failing the step function task
+CLIENT_CONFIG = botocore.config.Config(
+    max_pool_connections=int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '50')),
+    retries={
+        'mode': os.environ.get('CLIENT_RETRY_MODE', 'adaptive'),
+        'max_attempts': int(os.environ.get('CLIENT_MAX_ATTEMPTS', '10')),
+    },
+    connect_timeout=int(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5')),
+    read_timeout=int(os.environ.get('CLIENT_READ_TIMEOUT', '30')),
+    tcp_keepalive=True,
+)
+
+log = logging.getLogger(__name__)
+
+CachedClient = collections.namedtuple('CachedClient', ['client', 'expiration'])
+
+# Module scope so that warm Lambda invocations reuse credentials and clients.
+# Credentials are keyed by role arn. Clients are pooled per (account, region) the entries are deployed to and keyed
+# by (role arn, service) inside a pool, so one release can keep warm clients for every account and region it targets
+_credentials = {}
+_pools = collections.defaultdict(dict)
+_own_clients = {}
+_lock = threading.RLock()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _is_stale(expiration, now):
+    return expiration - CREDENTIAL_REFRESH_MARGIN <= now
+
+
+# Return a client for service using the function's own credentials, like sts to assume the deployment role or s3 to
+# read release payloads
+def get_own_client(service):
+    with _lock:
+        client = _own_clients.get(service)
+        if client is None:
+            client = metrics.instrument(boto3.client(service, config=CLIENT_CONFIG))
+            _own_clients[service] = client
+        return client
+
+
+def _sts():
+    return get_own_client('sts')
+
+
+# Drop every credential and client whose credentials are about to expire
+def _evict_stale(now):
+    for role_arn in [k for k, v in _credentials.items() if _is_stale(v['Expiration'], now)]:
+        log.info('Evicting expiring credentials for role %s', role_arn)
+        del _credentials[role_arn]
+    for pool_key, pool in list(_pools.items()):
+        for key in [k for k, v in pool.items() if _is_stale(v.expiration, now)]:
+            del pool[key]
+        if not pool:
+            del _pools[pool_key]
+
+
+def _assume_role(role_arn):
+    credentials = _credentials.get(role_arn)
+    if credentials is not None:
+        return credentials
+    log.info('Assuming role : %s', role_arn)
+    response = _sts().assume_role(RoleArn=role_arn,
+                                  RoleSessionName=ROLE_SESSION_NAME,
+                                  DurationSeconds=ASSUME_ROLE_DURATION_SECONDS)
+    credentials = response['Credentials']
+    log.info("Successfully assumed role %s, credentials expire at %s", role_arn, credentials['Expiration'])
+    _credentials[role_arn] = credentials
+    return credentials
+
+
+# Account of a role arn, arn:aws:iam::<account>:role/<name>
+def account_of(role_arn):
+    return role_arn.split(':')[4]
+
+
+# Arn of the role with the same name in another account, deployment roles have the same name in every account
+def role_in_account(role_arn, account):
+    parts = role_arn.split(':')
+    parts[4] = account
+    return ':'.join(parts)
+
+
+# Region an entry is deployed to
+def region_of(entry):
+    return entry.get('region') or DEFAULT_REGION
+
+
+# Group entries by the (account, region) client pool they are deployed with, keeping the order of the entries
+def group_by_pool(entries):
+    groups = collections.OrderedDict()
+    for entry in entries:
+        key = (account_of(entry['assumeRole']), region_of(entry))
+        groups.setdefault(key, []).append(entry)
+    return groups
+
+
+# (account, region) of the client pools currently kept warm
+def pools():
+    with _lock:
+        return list(_pools)
+
+
+# Return a client for service in region using the credentials of role_arn. Clients and credentials are cached across
+# invocations and rebuilt automatically once the credentials get close to expiry
+def get_client(service, role_arn, region):
+    pool = (account_of(role_arn), region)
+    key = (role_arn, service)
+    now = _now()
+    with _lock:
+        _evict_stale(now)
+        cached = _pools[pool].get(key)
+        if cached is not None:
+            return cached.client
+        credentials = _assume_role(role_arn)
+        client = boto3.client(
+            service,
+            region_name=region,
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            config=CLIENT_CONFIG
+        )
+        metrics.instrument(client)
+        _pools[pool][key] = CachedClient(client, credentials['Expiration'])
+        log.debug('Created %s client for role %s in pool %s', service, role_arn, pool)
+        return client
+
+
+def clear():
+    with _lock:
+        _credentials.clear()
+        _pools.clear()
+        _own_clients.clear()
@@ -0,0 +1,130 @@
+import botocore.exceptions
+import concurrent.futures
+import logging
+import os
+import re
+
+from deploy_common import clients
+
+
+# Pin task definitions to the digest of the deployed image, registry/repository@sha256:..., so a tag pushed again
+# later can't change what the service runs. Pinning needs the digests, so it turns resolution on as well
+PIN_IMAGE_DIGESTS = os.environ.get('PIN_IMAGE_DIGESTS', 'false').lower() == 'true'
+# Compare images by the digest ECR resolves their tags to instead of by name
+RESOLVE_IMAGE_DIGESTS = os.environ.get('RESOLVE_IMAGE_DIGESTS', 'false').lower() == 'true' or PIN_IMAGE_DIGESTS
+# batch_get_image accepts at most 100 image ids per call
+BATCH_GET_IMAGE_SIZE = 100
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+# Manifest lists and OCI indexes are accepted so multi architecture tags resolve to the digest ECS pulls
+MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+ECR_IMAGE = re.compile(r'^(?P<registry>\d{12})\.dkr\.ecr\.(?P<region>[a-z0-9-]+)\.amazonaws\.com(\.cn)?/'
+                       r'(?P<repository>[^:@]+)(:(?P<tag>[^@]+))?(@(?P<digest>sha256:[0-9a-f]{64}))?$')
+
+log = logging.getLogger(__name__)
+
+
+# registry, region, repository, tag and digest of an ECR image, None for images of other registries
+def parse(image):
+    match = ECR_IMAGE.match(image)
+    return match.groupdict() if match else None
+
+
+# Digest an image is pinned to in its name, if any
+def digest_in(image):
+    parsed = parse(image)
+    return parsed['digest'] if parsed else None
+
+
+# image pinned to digest, registry/repository@sha256:...
+def pin(image, digest):
+    parsed = parse(image)
+    name = image.split('@')[0]
+    if parsed['tag']:
+        name = name[:-len(parsed['tag']) - 1]
+    return name + '@' + digest
+
+
+# Digest of every tag of a repository that could be resolved. Errors of the repository, like a missing repository or
+# no access to the registry of another account, are logged and resolve none of its tags
+def _batch_get_image(assume_role, registry, region, repository, tags):
+    ecr_client = clients.get_client('ecr', assume_role, region)
+    digests = {}
+    for i in range(0, len(tags), BATCH_GET_IMAGE_SIZE):
+        try:
+            response = ecr_client.batch_get_image(
+                registryId=registry,
+                repositoryName=repository,
+                imageIds=[{'imageTag': tag} for tag in tags[i:i + BATCH_GET_IMAGE_SIZE]],
+                acceptedMediaTypes=MANIFEST_MEDIA_TYPES,
+            )
+        except botocore.exceptions.ClientError as e:
+            log.warning('Unable to resolve images of repository %s in registry %s: %s', repository, registry, e)
+            return {}
+        for image in response['images']:
+            digests[image['imageId']['imageTag']] = image['imageId']['imageDigest']
+        for failure in response.get('failures', []):
+            log.warning('Unable to resolve %s:%s: %s', repository, failure.get('imageId', {}).get('imageTag'),
+                        failure.get('failureReason'))
+    return digests
+
+
+# Resolve the digest of every ECR image in images with the credentials of assume_role. Tags of a repository are
+# resolved together, up to 100 per batch_get_image call, and repositories concurrently. Images pinned to a digest are
+# read from their name and images that can't be resolved are left out. digests caches the results of the invocation,
+# images already in it are not resolved again, and is updated and returned
+def resolve(images, assume_role, digests):
+    wanted = {}
+    for image in dict.fromkeys(images):
+        if image in digests:
+            continue
+        parsed = parse(image)
+        if parsed is None:
+            continue
+        if parsed['digest']:
+            digests[image] = parsed['digest']
+        elif parsed['tag']:
+            key = (parsed['registry'], parsed['region'], parsed['repository'])
+            wanted.setdefault(key, {})[parsed['tag']] = image
+    if not wanted:
+        return digests
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(_batch_get_image, assume_role, registry, region, repository, list(tags)): tags
+                   for (registry, region, repository), tags in wanted.items()}
+        for future, tags in futures.items():
+            for tag, digest in future.result().items():
+                digests[tags[tag]] = digest
+    log.info('Resolved %d image digests in %d repositories', sum(len(tags) for tags in wanted.values()), len(wanted))
+    return digests
+
+
+# Whether current and desired are the same image, by name or because both resolve to the same digest. Equal names are
+# always the same image, a tag pushed again is only told apart once the current image is pinned to its digest
+def same(current, desired, digests):
+    if current == desired:
+        return True
+    current_digest = digests.get(current) or digest_in(current)
+    return current_digest is not None and current_digest == (digests.get(desired) or digest_in(desired))
+
+
+# Resolve the current and deployment images of a deployment entry. The imageDigest InitConfig stamped on the entry is
+# used for the deployment image and stamped when it was missing. Returns the image to register, pinned to its digest
+# when PIN_IMAGE_DIGESTS is on
+def resolve_entry(event, current_image, digests):
+    deployment_image = event['image']
+    if not RESOLVE_IMAGE_DIGESTS or current_image == deployment_image:
+        return deployment_image
+    if event.get('imageDigest'):
+        digests.setdefault(deployment_image, event['imageDigest'])
+    resolve([current_image, deployment_image], event['assumeRole'], digests)
+    if deployment_image in digests:
+        event['imageDigest'] = digests[deployment_image]
+        if PIN_IMAGE_DIGESTS:
+            return pin(deployment_image, digests[deployment_image])
+    return deployment_image
@@ -0,0 +1,113 @@
+import collections
+import json
+import logging
+import os
+import random
+
+
+DEFAULT_LOG_LEVEL = logging.DEBUG
+LOG_LEVELS = collections.defaultdict(
+    lambda: DEFAULT_LOG_LEVEL,
+    {
+        "critical": logging.CRITICAL,
+        "error": logging.ERROR,
+        "warning": logging.WARNING,
+        "info": logging.INFO,
+        "debug": logging.DEBUG,
+    },
+)
+# 'text' keeps the default Lambda log lines, 'json' writes one json object per record
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# Payloads logged through lazy_json are cut after this many characters, 0 disables truncation
+LOG_PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', '2048'))
+# Share of verbose records, the ones logged with extra=VERBOSE, that are actually written
+LOG_VERBOSE_SAMPLE_RATE = float(os.environ.get('LOG_VERBOSE_SAMPLE_RATE', '1.0'))
+
+VERBOSE = {'verbose': True}
+
+_configured = False
+
+
+# Serializes obj only when the record is formatted, so records dropped by level or sampling cost nothing
+class LazyJson:
+    def __init__(self, obj, limit=None):
+        self.obj = obj
+        self.limit = LOG_PAYLOAD_LIMIT if limit is None else limit
+
+    def __str__(self):
+        text = json.dumps(self.obj, default=str, separators=(',', ':'))
+        if self.limit and len(text) > self.limit:
+            return text[:self.limit] + '...(%d more chars)' % (len(text) - self.limit)
+        return text
+
+
+def lazy_json(obj, limit=None):
+    return LazyJson(obj, limit)
+
+
+# Container definitions logged as name and image only, environment blocks and the like are left out
+class LazyContainers:
+    def __init__(self, container_definitions):
+        self.container_definitions = container_definitions
+
+    def __str__(self):
+        return str(LazyJson([{'name': c.get('name'), 'image': c.get('image')} for c in self.container_definitions]))
+
+
+def containers(container_definitions):
+    return LazyContainers(container_definitions)
+
+
+class LazyTaskDefinition:
+    def __init__(self, task_definition):
+        self.task_definition = task_definition
+
+    def __str__(self):
+        return 'family=%s containers=%s' % (self.task_definition.get('family'),
+                                            LazyContainers(self.task_definition.get('containerDefinitions', [])))
+
+
+def task_definition(task_definition):
+    return LazyTaskDefinition(task_definition)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'verbose', False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Lambda initializes a root logger that needs to be removed in order to set a different logging config. Runs once per
+# process, steps loaded later by the dispatcher keep the same config
+def setup():
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    root = logging.getLogger()
+    if root.handlers:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+    logging.basicConfig(level=LOG_LEVELS[os.environ.get("LOG_LEVEL", "").lower()])
+    for handler in root.handlers:
+        handler.addFilter(SamplingFilter(LOG_VERBOSE_SAMPLE_RATE))
+        if LOG_FORMAT == 'json':
+            handler.setFormatter(JsonFormatter())
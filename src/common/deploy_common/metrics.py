@@ -0,0 +1,178 @@
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'GitOpsEcsDeployer')
+EMIT_METRICS = os.environ.get('EMIT_METRICS', 'true').lower() == 'true'
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'RateExceeded',
+}
+# Embedded Metric Format allows at most 100 metrics per record
+MAX_METRICS = 100
+
+log = logging.getLogger(__name__)
+
+OperationStats = collections.namedtuple('OperationStats', ['calls', 'latency', 'max_latency', 'retries', 'throttles',
+                                                           'errors'])
+_EMPTY = OperationStats(0, 0.0, 0.0, 0, 0, 0)
+
+# Stats per api operation and counters of the current invocation, reset on every flush
+_stats = {}
+_counters = collections.Counter()
+# Action the dispatcher runs, emitted as the Step dimension
+_step = None
+_lock = threading.Lock()
+
+
+def _operation(event_name):
+    return event_name.rsplit('.', 1)[-1]
+
+
+def _add(operation, **values):
+    with _lock:
+        stats = _stats.get(operation, _EMPTY)
+        _stats[operation] = stats._replace(
+            calls=stats.calls + values.get('calls', 0),
+            latency=stats.latency + values.get('latency', 0.0),
+            max_latency=max(stats.max_latency, values.get('latency', 0.0)),
+            retries=stats.retries + values.get('retries', 0),
+            throttles=stats.throttles + values.get('throttles', 0),
+            errors=stats.errors + values.get('errors', 0),
+        )
+
+
+def set_step(step):
+    global _step
+    _step = step
+
+
+# Add value to the counter name of the invocation, emitted as a Count metric
+def count(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def _before_call(context, **kwargs):
+    context['metrics_started'] = time.perf_counter()
+
+
+def _after_call(event_name, parsed, context, **kwargs):
+    latency = (time.perf_counter() - context.get('metrics_started', time.perf_counter())) * 1000
+    parsed = parsed or {}
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    errors = 1 if 'Error' in parsed else 0
+    _add(_operation(event_name), calls=1, latency=latency, retries=retries, errors=errors)
+
+
+def _after_call_error(event_name, context, **kwargs):
+    latency = (time.perf_counter() - context.get('metrics_started', time.perf_counter())) * 1000
+    _add(_operation(event_name), calls=1, latency=latency, errors=1)
+
+
+def _needs_retry(event_name, response=None, **kwargs):
+    if response is not None:
+        code = (response[1] or {}).get('Error', {}).get('Code')
+        if code in THROTTLING_ERROR_CODES:
+            _add(_operation(event_name), throttles=1)
+    # never decide on the retry, botocore's own retry handler does
+
+
+# Time every api call of client and count its retries and throttles through botocore's event hooks
+def instrument(client):
+    events = client.meta.events
+    events.register('before-call.*.*', _before_call, unique_id='deploy-metrics-before-call')
+    events.register('after-call.*.*', _after_call, unique_id='deploy-metrics-after-call')
+    events.register('after-call-error.*.*', _after_call_error, unique_id='deploy-metrics-after-call-error')
+    events.register('needs-retry.*.*', _needs_retry, unique_id='deploy-metrics-needs-retry')
+    return client
+
+
+def _dimensions(event, context):
+    dimensions = {'Function': getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME',
+                                                                                        'local')}
+    if _step is not None:
+        dimensions['Step'] = _step
+    if isinstance(event, dict):
+        for dimension, key in (('Release', 'release'), ('ClusterName', 'clusterName'), ('ServiceName', 'serviceName'),
+                               ('RuleName', 'cwRuleName')):
+            if event.get(key) is not None:
+                dimensions[dimension] = str(event[key])
+    return dimensions
+
+
+# Embedded Metric Format record with the totals, the counters and the per operation breakdown of the invocation
+def build_record(dimensions, duration, stats, counters=None):
+    values = {
+        'Duration': (duration * 1000, 'Milliseconds'),
+        'ApiCalls': (sum(s.calls for s in stats.values()), 'Count'),
+        'ApiLatency': (sum(s.latency for s in stats.values()), 'Milliseconds'),
+        'Retries': (sum(s.retries for s in stats.values()), 'Count'),
+        'Throttles': (sum(s.throttles for s in stats.values()), 'Count'),
+        'Errors': (sum(s.errors for s in stats.values()), 'Count'),
+    }
+    for name, value in sorted((counters or {}).items()):
+        values[name] = (value, 'Count')
+    for operation, s in sorted(stats.items()):
+        values[operation + 'Calls'] = (s.calls, 'Count')
+        values[operation + 'Latency'] = (s.latency, 'Milliseconds')
+        values[operation + 'MaxLatency'] = (s.max_latency, 'Milliseconds')
+        if s.retries:
+            values[operation + 'Retries'] = (s.retries, 'Count')
+        if s.throttles:
+            values[operation + 'Throttles'] = (s.throttles, 'Count')
+    names = list(values)[:MAX_METRICS]
+    dimension_sets = [['Function']]
+    for keys in (['Function', 'Step'], ['Function', 'Release'], ['Function', 'ClusterName'],
+                 ['Function', 'ClusterName', 'ServiceName'], ['Function', 'RuleName']):
+        if all(k in dimensions for k in keys):
+            dimension_sets.append(keys)
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': dimension_sets,
+                'Metrics': [{'Name': name, 'Unit': values[name][1]} for name in names],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update({name: round(values[name][0], 3) for name in names})
+    return record
+
+
+# Write the metrics of the invocation to stdout, where Lambda ships them to CloudWatch Logs, and reset the stats
+def flush(event, context, duration):
+    with _lock:
+        stats = dict(_stats)
+        counters = dict(_counters)
+        _stats.clear()
+        _counters.clear()
+    if not EMIT_METRICS:
+        return
+    try:
+        print(json.dumps(build_record(_dimensions(event, context), duration, stats, counters)), flush=True)
+    except Exception as e:
+        log.warning('Unable to emit metrics: %s', e)
+
+
+# Decorator for handlers, flushes one metrics record at the end of every invocation
+def instrumented(handler):
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            flush(event, context, time.perf_counter() - started)
+    return wrapper
@@ -0,0 +1,67 @@
+import botocore.exceptions
+import json
+import logging
+import os
+
+from deploy_common import clients
+
+
+# When enabled InitConfig writes the services and tasks of the release to RELEASE_BUCKET in chunks and the step
+# function only passes references to the chunks around, keeping the state payload the same size for any release
+OFFLOAD_PAYLOADS = os.environ.get('OFFLOAD_PAYLOADS', 'false').lower() == 'true'
+RELEASE_BUCKET = os.environ.get('RELEASE_BUCKET')
+PAYLOAD_CHUNK_SIZE = int(os.environ.get('PAYLOAD_CHUNK_SIZE', '10'))
+PAYLOAD_PREFIX = 'releases'
+
+log = logging.getLogger(__name__)
+
+
+def is_reference(event):
+    return isinstance(event, dict) and 'payloadRef' in event
+
+
+def _s3():
+    return clients.get_own_client('s3')
+
+
+def write(bucket, key, entries):
+    body = json.dumps(entries, separators=(',', ':'), default=str)
+    _s3().put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json')
+    log.info('Wrote %d entries to s3://%s/%s', len(entries), bucket, key)
+
+
+# Object stored as json at key, None when there is no such object
+def read(bucket, key):
+    try:
+        response = _s3().get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+# Entries of the chunk an event references
+def load(event):
+    ref = event['payloadRef']
+    response = _s3().get_object(Bucket=ref['bucket'], Key=ref['key'])
+    entries = json.loads(response['Body'].read())
+    log.info('Loaded %d entries from s3://%s/%s', len(entries), ref['bucket'], ref['key'])
+    return entries
+
+
+# Write the entries back to the chunk an event references, so the next step sees the results
+def store(event, entries):
+    ref = event['payloadRef']
+    write(ref['bucket'], ref['key'], entries)
+
+
+# Write entries in chunks of PAYLOAD_CHUNK_SIZE under prefix and return one reference event per chunk
+def offload(prefix, name, entries, **fields):
+    refs = []
+    for i in range(0, len(entries), PAYLOAD_CHUNK_SIZE):
+        key = '%s/%s-%04d.json' % (prefix, name, i // PAYLOAD_CHUNK_SIZE)
+        chunk = entries[i:i + PAYLOAD_CHUNK_SIZE]
+        write(RELEASE_BUCKET, key, chunk)
+        refs.append(dict(fields, payloadRef={'bucket': RELEASE_BUCKET, 'key': key}, entries=len(chunk)))
+    return refs
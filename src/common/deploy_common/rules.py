@@ -0,0 +1,20 @@
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# Every ECS target of a scheduled task rule, following NextToken. Targets of other kinds are left out
+def list_ecs_targets(events_client, cw_rule_name):
+    targets = []
+    kwargs = {}
+    while True:
+        response = events_client.list_targets_by_rule(
+            Rule=cw_rule_name,
+            **kwargs
+        )
+        targets.extend(target for target in response['Targets'] if 'EcsParameters' in target)
+        next_token = response.get('NextToken')
+        if not next_token:
+            return targets
+        kwargs['NextToken'] = next_token
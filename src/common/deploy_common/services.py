@@ -0,0 +1,29 @@
+import logging
+
+
+# describe_services accepts at most 10 services per call
+DESCRIBE_SERVICES_BATCH_SIZE = 10
+
+log = logging.getLogger(__name__)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Describe many services of a single cluster, 10 services per describe_services call. Services that can't be described
+# are logged and left out. Returns a dict of service name or arn -> service
+def describe(ecs_client, cluster_name, service_names):
+    services = {}
+    for chunk in chunks(list(dict.fromkeys(service_names)), DESCRIBE_SERVICES_BATCH_SIZE):
+        response = ecs_client.describe_services(
+            cluster=cluster_name,
+            services=chunk
+        )
+        for failure in response.get('failures', []):
+            log.warning('Unable to describe service %s: %s', failure.get('arn'), failure.get('reason'))
+        for current_service in response['services']:
+            services[current_service['serviceName']] = current_service
+            services[current_service['serviceArn']] = current_service
+    return services
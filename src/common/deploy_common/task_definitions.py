@@ -0,0 +1,187 @@
+import collections
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import weakref
+
+from deploy_common import metrics
+
+
+# Tag stored on every revision registered by the pipeline with the hash of its content
+CONTENT_HASH_TAG = 'gitops-content-hash'
+# Number of most recent revisions of a family checked for identical content before registering a new one
+RECENT_REVISIONS = int(os.environ.get('DEDUP_RECENT_REVISIONS', '5'))
+# Task definition fields copied to the new revision
+REGISTER_FIELDS = (
+    'family',
+    'taskRoleArn',
+    'executionRoleArn',
+    'networkMode',
+    'containerDefinitions',
+    'volumes',
+    'placementConstraints',
+    'requiresCompatibilities',
+    'cpu',
+    'memory',
+)
+
+# A task definition revision never changes, so described revisions are kept across warm invocations, keyed by the full
+# revision arn. The least recently used ones are evicted past CACHE_SIZE revisions or CACHE_BYTES of json
+CACHE_SIZE = int(os.environ.get('TASK_DEFINITION_CACHE_SIZE', '1000'))
+CACHE_BYTES = int(os.environ.get('TASK_DEFINITION_CACHE_BYTES', str(32 * 1024 * 1024)))
+# family:revision names and bare family names resolve to whatever is latest and are never cached
+REVISION_ARN = re.compile(r'^arn:aws[a-z-]*:ecs:[a-z0-9-]+:\d{12}:task-definition/[^:/]+:\d+$')
+
+log = logging.getLogger(__name__)
+
+CacheEntry = collections.namedtuple('CacheEntry', ['task_definition', 'tags', 'size'])
+
+# Local index of content hash -> task definition arn, per ecs client so that revisions are only reused within the
+# account and region they were registered in. Lives at module scope to survive warm invocations
+_index = weakref.WeakKeyDictionary()
+# revision arn -> CacheEntry, least recently used first
+_cache = collections.OrderedDict()
+_cache_stats = collections.Counter()
+_lock = threading.Lock()
+
+
+# Arguments for register_task_definition built from a described task definition
+def registration_fields(task_definition):
+    return {k: task_definition[k] for k in REGISTER_FIELDS if task_definition.get(k) is not None}
+
+
+# Canonical hash of the registration arguments, independent of key order
+def content_hash(fields):
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def family_of(task_definition_arn):
+    return task_definition_arn.rsplit('/', 1)[-1].rsplit(':', 1)[0]
+
+
+# Container of a task definition running the image of service, required if task definitions have multiple containers
+# like sidecars. Scheduled tasks can fall back to the first container, their name doesn't always match the image
+def find_container(containers, service, fallback_to_first=False):
+    for x in containers:
+        if service in x['image']:
+            return x
+    if fallback_to_first and len(containers) > 0:
+        return containers[0]
+    return None
+
+
+# Keep a described or registered task definition, with its tags when they are known
+def cache_put(task_definition, tags=None):
+    task_definition_arn = task_definition['taskDefinitionArn']
+    if not REVISION_ARN.match(task_definition_arn):
+        return
+    size = len(json.dumps(task_definition, separators=(',', ':'), default=str))
+    if size > CACHE_BYTES:
+        return
+    entry = CacheEntry(copy.deepcopy(task_definition), copy.deepcopy(tags), size)
+    with _lock:
+        previous = _cache.pop(task_definition_arn, None)
+        if previous is not None:
+            _cache_stats['bytes'] -= previous.size
+            if tags is None:
+                entry = entry._replace(tags=previous.tags)
+        _cache[task_definition_arn] = entry
+        _cache_stats['bytes'] += size
+        while len(_cache) > CACHE_SIZE or _cache_stats['bytes'] > CACHE_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_stats['bytes'] -= evicted.size
+            _cache_stats['evictions'] += 1
+
+
+# describe_task_definition through the cache. Returns a response with taskDefinition, and tags when include_tags is
+# set, that the caller is free to modify. Tags are always described so later lookups with include_tags hit the cache
+def describe(ecs_client, task_definition_arn, include_tags=False):
+    with _lock:
+        entry = _cache.get(task_definition_arn)
+        if entry is not None and (entry.tags is not None or not include_tags):
+            _cache.move_to_end(task_definition_arn)
+            _cache_stats['hits'] += 1
+        else:
+            entry = None
+            _cache_stats['misses'] += 1
+    if entry is not None:
+        metrics.count('TaskDefinitionCacheHits')
+        response = {'taskDefinition': copy.deepcopy(entry.task_definition)}
+        if include_tags:
+            response['tags'] = copy.deepcopy(entry.tags)
+        return response
+
+    metrics.count('TaskDefinitionCacheMisses')
+    response = ecs_client.describe_task_definition(
+        taskDefinition=task_definition_arn,
+        include=['TAGS']
+    )
+    cache_put(response['taskDefinition'], response.get('tags', []))
+    return response
+
+
+# hits, misses and evictions since the cold start and the revisions and bytes cached
+def cache_stats():
+    with _lock:
+        return dict(_cache_stats, entries=len(_cache))
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+        _cache_stats.clear()
+
+
+def _remember(ecs_client, digest, task_definition_arn):
+    with _lock:
+        _index.setdefault(ecs_client, {})[digest] = task_definition_arn
+
+
+# Look for an active revision of family with the same content, first in the local index and then in the most recent
+# revisions of the family, matching either the content hash tag or the hash of the described content
+def find_existing_revision(ecs_client, family, digest):
+    with _lock:
+        task_definition_arn = _index.get(ecs_client, {}).get(digest)
+    if task_definition_arn is not None:
+        return task_definition_arn
+    response = ecs_client.list_task_definitions(
+        familyPrefix=family,
+        status='ACTIVE',
+        sort='DESC',
+        maxResults=RECENT_REVISIONS
+    )
+    for task_definition_arn in response['taskDefinitionArns']:
+        # familyPrefix also matches longer family names
+        if family_of(task_definition_arn) != family:
+            continue
+        response = describe(ecs_client, task_definition_arn, include_tags=True)
+        tags = {tag['key']: tag['value'] for tag in response.get('tags', [])}
+        if tags.get(CONTENT_HASH_TAG) == digest or \
+                content_hash(registration_fields(response['taskDefinition'])) == digest:
+            _remember(ecs_client, digest, task_definition_arn)
+            return task_definition_arn
+    return None
+
+
+# Register a task definition with the given fields, unless a recent revision of the family already has identical
+# content in which case its arn is returned instead
+def register(ecs_client, fields):
+    digest = content_hash(fields)
+    existing = find_existing_revision(ecs_client, fields['family'], digest)
+    if existing is not None:
+        log.info('Reusing task definition %s with identical content %s', existing, digest)
+        return existing
+    response = ecs_client.register_task_definition(
+        tags=[{'key': CONTENT_HASH_TAG, 'value': digest}],
+        **fields
+    )
+    task_definition_arn = response['taskDefinition']['taskDefinitionArn']
+    _remember(ecs_client, digest, task_definition_arn)
+    # later lookups of the new revision, like the next release reading the current image, skip the api
+    cache_put(response['taskDefinition'], response.get('tags', [{'key': CONTENT_HASH_TAG, 'value': digest}]))
+    return task_definition_arn
@@ -1,33 +1,24 @@
-import boto3
 import collections
-import json
+import concurrent.futures
 import logging
 import os
 
+from deploy_common import clients
+from deploy_common import images
+from deploy_common import logs
+from deploy_common import metrics
+from deploy_common import payloads
+from deploy_common import services as ecs_services
+from deploy_common import task_definitions
+
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-REGION = os.environ['REGION']
 ACCOUNT_ID = os.environ['ACCOUNT_ID']
-sts_client = boto3.client('sts')
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    },
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-logging.basicConfig(level=LOG_LEVELS[os.environ.get("LOG_LEVEL", "").lower()])
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+# Fields the validation step adds while polling a rollout, cleared before the rollback is validated
+ROLLOUT_FIELDS = ('deploymentReady', 'rolloutProgress', 'nextPollSeconds', 'pollStartedAt', 'pollAttempts', 'newTasks',
+                  'oldTasks')
+
+logs.setup()
 log = logging.getLogger(__name__)
 
 
@@ -48,16 +39,25 @@ def retrieve_current_task_def(ecs_client, cluster_name, service_name):
     return cluster_arn, service_arn, task_definition_arn
 
 
-# Retrieve Current Image url from current task definition
+# Retrieve Current Task definitions of many services of a single cluster, 10 services per describe_services call.
+# Returns a dict of service name or arn -> (cluster_arn, service_arn, task_definition_arn)
+def retrieve_current_task_defs(ecs_client, cluster_name, service_names):
+    current_task_defs = {
+        key: (current_service['clusterArn'], current_service['serviceArn'], current_service['taskDefinition'])
+        for key, current_service in ecs_services.describe(ecs_client, cluster_name, service_names).items()
+    }
+    log.info('current task definitions of %d services in cluster %s retrieved', len(service_names), cluster_name)
+    return current_task_defs
+
+
+# Retrieve Current Image url from current task definition, revisions described before are read from the cache
 def retrieve_current_image(ecs_client, task_definition_arn, service):
-    response = ecs_client.describe_task_definition(
-        taskDefinition=task_definition_arn
-    )
+    response = task_definitions.describe(ecs_client, task_definition_arn)
     task_definition = response['taskDefinition']
     container_definitions = task_definition['containerDefinitions']
-    log.info(container_definitions)
+    log.debug('Current container definitions: %s', logs.containers(container_definitions), extra=logs.VERBOSE)
     # required if task definition has multiple containers like sidecars
-    container_definition = find_container(container_definitions, service)
+    container_definition = task_definitions.find_container(container_definitions, service)
     if container_definition is None:
         message = 'Couldnt find any image containing ' + service + ' in current taskDefinition ' + task_definition_arn + '. Aborting '
         raise Exception(message)
@@ -69,31 +69,11 @@ def retrieve_current_image(ecs_client, task_definition_arn, service):
 def register_new_task_definition(ecs_client, task_definition, current_image, deployment_image):
     container_definitions = task_definition['containerDefinitions']
     # required if task definition has multiple containers like sidecars
-    container_definition = find_container(container_definitions, current_image)
+    container_definition = task_definitions.find_container(container_definitions, current_image)
     container_definition['image'] = deployment_image
-    log.info('New Task def %s', task_definition)
-    task_family = task_definition.get('family')
-    taskRoleArn = task_definition.get('taskRoleArn')
-    executionRoleArn = task_definition.get('executionRoleArn')
-    networkMode = task_definition.get('networkMode')
-    volumes = task_definition.get('volumes')
-    placementConstraints = task_definition.get('placementConstraints')
-    requiresCompatibilities = task_definition.get('requiresCompatibilities')
-    cpu = task_definition.get('cpu')
-    memory = task_definition.get('memory')
-    response = ecs_client.register_task_definition(
-        family=task_family,
-        taskRoleArn=taskRoleArn,
-        executionRoleArn=executionRoleArn,
-        networkMode=networkMode,
-        containerDefinitions=container_definitions,
-        volumes=volumes,
-        placementConstraints=placementConstraints,
-        requiresCompatibilities=requiresCompatibilities,
-        cpu=cpu,
-        memory=memory
-    )
-    new_task_def = response['taskDefinition']['taskDefinitionArn']
+    log.debug('New Task def %s', logs.task_definition(task_definition), extra=logs.VERBOSE)
+    # reuses an existing revision when one with identical content was registered before
+    new_task_def = task_definitions.register(ecs_client, task_definitions.registration_fields(task_definition))
     log.info('New task definition: %s', new_task_def)
     return new_task_def
 
@@ -112,47 +92,23 @@ def update_service(ecs_client, cluster_arn, service_name, deployment_task_arn):
     return
 
 
-def find_container(containers, service):
-    for x in containers:
-        if service in x['image']:
-            return x
-    return None
-
-
-def handler(event, context):
-    log.info("Received event: %s", json.dumps(event))
+# Deploy the image of a single service entry whose current task definition is already known. Adds previousImage,
+# previousTaskDefArn, deployedTaskDefArn and deploymentNeeded to the entry. digests caches the image digests of the
+# invocation
+def deploy_service(ecs_client, event, cluster_arn, task_definition_arn, digests=None):
     service = event['service']
     deployment_image = event['image']
-    assume_role = event['assumeRole']
-    cluster_name = event['clusterName']
     service_name = event['serviceName']
-
-    # Assume Role
-    log.info('Assuming role : %s', assume_role)
-    assumed_role = sts_client.assume_role(RoleArn=assume_role,
-                                          RoleSessionName="AssumeRoleSession1",
-                                          DurationSeconds=1800)
-    log.info("Successfully assumed role %s", assume_role)
-
-    # Describe Service to retrieve Task Definition
-    ecs_client = boto3.client(
-        'ecs',
-        region_name=REGION,
-        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-        aws_session_token=assumed_role['Credentials']['SessionToken']
-    )
-    # Retrieve Task Definition
-    log.info('Retrieving current task definition for service: %s', service_name)
-    cluster_arn, service_arn, task_definition_arn = retrieve_current_task_def(ecs_client, cluster_name, service_name)
+    digests = {} if digests is None else digests
 
     # Get Current Image
     log.info('Retrieving current image name for service in taskDefinition: %s', task_definition_arn)
     current_image, current_task_definition = retrieve_current_image(ecs_client, task_definition_arn, service)
+    registered_image = images.resolve_entry(event, current_image, digests)
 
     # compare current image with existing image to check if new deployment is needed
     log.info('Comparing %s with %s', current_image, deployment_image)
-    if current_image == deployment_image:
+    if images.same(current_image, deployment_image, digests):
         log.info('image matches no new deployment needed')
         event['previousImage'] = current_image
         event['previousTaskDefArn'] = task_definition_arn
@@ -160,15 +116,171 @@ def handler(event, context):
         event['deploymentNeeded'] = False
     else:
         log.info('image dos not match new deployment needed')
-        log.info('Creating new Task definition using %s', deployment_image)
+        log.info('Creating new Task definition using %s', registered_image)
         deployment_task_arn = register_new_task_definition(ecs_client, current_task_definition, current_image,
-                                                           deployment_image)
+                                                           registered_image)
         log.info('Updating ECS service %s with new task definition %s', service_name, task_definition_arn)
         update_service(ecs_client, cluster_arn, service_name, deployment_task_arn)
         event['previousImage'] = current_image
         event['previousTaskDefArn'] = task_definition_arn
         event['deployedTaskDefArn'] = deployment_task_arn
         event['deploymentNeeded'] = True
+    return event
+
+
+@metrics.instrumented
+def handler(event, context):
+    log.info("Received event: %s", logs.lazy_json(event))
+    if payloads.is_reference(event):
+        return chunk_handler(event, context)
+    assume_role = event['assumeRole']
+    cluster_name = event['clusterName']
+    service_name = event['serviceName']
+
+    # Assume Role and Describe Service to retrieve Task Definition
+    ecs_client = clients.get_client('ecs', assume_role, clients.region_of(event))
+
+    # Retrieve Task Definition
+    log.info('Retrieving current task definition for service: %s', service_name)
+    cluster_arn, service_arn, task_definition_arn = retrieve_current_task_def(ecs_client, cluster_name, service_name)
+
+    deploy_service(ecs_client, event, cluster_arn, task_definition_arn)
+
+    log.info("Received event: %s", logs.lazy_json(event))
+    return event
+
+
+# Deploy many services, grouped by assumeRole, region and clusterName, described in chunks of 10 and deployed
+# concurrently. Services of every account and region are deployed together, each with the clients of its pool.
+# Every entry gets the same fields as handler would add, or an error field if that service failed.
+# Returns the names of the failed services
+def deploy_services(services):
+    groups = collections.defaultdict(list)
+    for service in services:
+        groups[(service['assumeRole'], clients.region_of(service), service['clusterName'])].append(service)
+    digests = {}
+
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for (assume_role, region, cluster_name), group in groups.items():
+            ecs_client = clients.get_client('ecs', assume_role, region)
+            service_names = list(dict.fromkeys(service['serviceName'] for service in group))
+            current_task_defs = retrieve_current_task_defs(ecs_client, cluster_name, service_names)
+            for service in group:
+                current = current_task_defs.get(service['serviceName'])
+                if current is None:
+                    service['error'] = 'Service ' + service['serviceName'] + ' not found in cluster ' + cluster_name
+                    continue
+                cluster_arn, service_arn, task_definition_arn = current
+                future = executor.submit(deploy_service, ecs_client, service, cluster_arn, task_definition_arn,
+                                         digests)
+                futures[future] = service
 
-    log.info("Received event: %s", json.dumps(event))
+    for future, service in futures.items():
+        error = future.exception()
+        if error is not None:
+            log.error('Deployment of service %s failed: %s', service['serviceName'], error)
+            service['error'] = str(error)
+
+    failed = [service['serviceName'] for service in services if 'error' in service]
+    log.info('Processed %d services, %d failed', len(services), len(failed))
+    return failed
+
+
+# Deploy many services in one invocation. The event contains a list of service entries in the same shape as handler
+# expects, failed services are listed in failedServices
+@metrics.instrumented
+def batch_handler(event, context):
+    services = event['services']
+    log.info('Received batch of %d services in %d accounts and regions', len(services),
+             len(clients.group_by_pool(services)))
+    event['failedServices'] = deploy_services(services)
+    return event
+
+
+# Deploy the services of a release chunk stored in S3 and write the results back to it. Services deployed by an
+# earlier attempt are not deployed again, so a retry doesn't lose their deploymentNeeded flag
+def chunk_handler(event, context):
+    services = payloads.load(event)
+    pending = []
+    for service in services:
+        service.pop('error', None)
+        if 'deployedTaskDefArn' not in service:
+            pending.append(service)
+    failed = deploy_services(pending)
+    payloads.store(event, services)
+    if failed:
+        message = 'Deployment failed for services: ' + ', '.join(failed)
+        raise Exception(message)
+    event['deploymentNeeded'] = any(service['deploymentNeeded'] for service in services)
+    return event
+
+
+# A service needs a rollback when it was updated and its validation failed: the validation step marked it with a
+# validationError in a release chunk, or the state machine caught the error of its own validation in deploymentError.
+# Services of a chunk that are still rolling out are left alone
+def needs_rollback(service):
+    return service.get('deploymentNeeded', False) and not service.get('deploymentReady', False) \
+        and not service.get('rolledBack', False) and bool(service.get('validationError') or
+                                                          service.get('deploymentError'))
+
+
+# Roll the service back to the task definition it ran before the deployment, nothing is registered. The entry is left
+# for the validation step to check the rollback: deployedTaskDefArn becomes the previous task definition and the poll
+# state of the failed rollout is cleared
+def rollback_service(ecs_client, event):
+    service_name = event['serviceName']
+    failed_task_arn = event['deployedTaskDefArn']
+    previous_task_arn = event['previousTaskDefArn']
+    log.info('Rolling back ECS service %s from %s to %s', service_name, failed_task_arn, previous_task_arn)
+    update_service(ecs_client, event['clusterName'], service_name, previous_task_arn)
+    for field in ROLLOUT_FIELDS:
+        event.pop(field, None)
+    event['rolledBackTaskDefArn'] = failed_task_arn
+    event['deployedTaskDefArn'] = previous_task_arn
+    event['deploymentNeeded'] = True
+    event['rolledBack'] = True
+    return event
+
+
+# Roll back many services concurrently. Returns the names of the services that couldn't be rolled back
+def rollback_services(services):
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for service in services:
+            ecs_client = clients.get_client('ecs', service['assumeRole'], clients.region_of(service))
+            futures[executor.submit(rollback_service, ecs_client, service)] = service
+
+    failed = []
+    for future, service in futures.items():
+        error = future.exception()
+        if error is not None:
+            log.error('Rollback of service %s failed: %s', service['serviceName'], error)
+            failed.append(service['serviceName'])
+    log.info('Rolled back %d services, %d failed', len(services), len(failed))
+    return failed
+
+
+# Entry point of the rollback step the state machine runs when the validation of a service, or of a release chunk
+# stored in S3, fails. Only the services whose validation failed are rolled back. The chunk is marked rolledBack when
+# at least one of its services was, otherwise its services are simply validated again
+@metrics.instrumented
+def rollback_handler(event, context):
+    log.info("Received event: %s", logs.lazy_json(event))
+    reference = payloads.is_reference(event)
+    services = payloads.load(event) if reference else [event]
+    rolled_back = [service for service in services if needs_rollback(service)]
+    failed = rollback_services(rolled_back)
+    if reference:
+        payloads.store(event, services)
+        for field in ROLLOUT_FIELDS:
+            event.pop(field, None)
+        event.pop('deploymentError', None)
+        if rolled_back:
+            event['rolledBack'] = True
+        else:
+            log.warning('No service of the chunk failed its validation, nothing to roll back')
+    if failed:
+        message = 'Rollback failed for services: ' + ', '.join(failed)
+        raise Exception(message)
     return event
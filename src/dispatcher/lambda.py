@@ -0,0 +1,65 @@
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+from deploy_common import logs
+from deploy_common import metrics
+
+# Code of the steps, one directory per step next to this one
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# action of the event -> (step, handler of the step)
+ACTIONS = {
+    'init': ('init', 'handler'),
+    'deploy-task': ('task', 'handler'),
+    'deploy-tasks': ('task', 'batch_handler'),
+    'deploy': ('deploy', 'handler'),
+    'deploy-services': ('deploy', 'batch_handler'),
+    'rollback': ('deploy', 'rollback_handler'),
+    'validate': ('validate', 'handler'),
+}
+# Steps imported during the cold start instead of on their first action, comma separated
+PRELOAD_STEPS = [step for step in os.environ.get('PRELOAD_STEPS', '').split(',') if step]
+
+logs.setup()
+log = logging.getLogger(__name__)
+
+# Module scope so that warm invocations reuse the steps already imported, whatever action they run
+_steps = {}
+_lock = threading.Lock()
+
+
+# Import the code of a step the first time one of its actions runs. The steps share the clients, credentials and
+# caches of deploy_common, so a container warmed by one step serves the others
+def load(step):
+    with _lock:
+        module = _steps.get(step)
+        if module is None:
+            started = time.perf_counter()
+            spec = importlib.util.spec_from_file_location(step + '_step', os.path.join(SRC_DIR, step, 'lambda.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _steps[step] = module
+            log.info('Loaded step %s in %.1f ms', step, (time.perf_counter() - started) * 1000)
+        return module
+
+
+# Single entry point of every step. The action field picks the handler, which receives the event field, as the state
+# machine passes it, or else the rest of the event
+def handler(event, context):
+    action = event.get('action')
+    if action not in ACTIONS:
+        message = 'Unknown action: ' + str(action) + '. Aborting '
+        raise Exception(message)
+    step, name = ACTIONS[action]
+    if 'event' in event:
+        payload = event['event']
+    else:
+        payload = {key: value for key, value in event.items() if key != 'action'}
+    metrics.set_step(action)
+    return getattr(load(step), name)(payload, context)
+
+
+for preloaded in PRELOAD_STEPS:
+    load(preloaded)
@@ -1,39 +1,304 @@
-import boto3
 import collections
+import concurrent.futures
 import json
 import logging
 import os
+import uuid
+
+from deploy_common import clients
+from deploy_common import images
+from deploy_common import logs
+from deploy_common import metrics
+from deploy_common import payloads
+from deploy_common import rules
+from deploy_common import services as ecs_services
+from deploy_common import task_definitions
 
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-REGION = os.environ['REGION']
 ACCOUNT_ID = os.environ['ACCOUNT_ID']
 ECS_DEPLOYMENT_ROLE_ARN = os.environ['ECS_DEPLOYMENT_ROLE_ARN']
+# Drop services and tasks whose image is already deployed before they reach the step function Map states
+PRUNE_UNCHANGED = os.environ.get('PRUNE_UNCHANGED', 'true').lower() == 'true'
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+# Services of one cluster deployed at the same time in a wave
+MAX_SERVICES_PER_CLUSTER = int(os.environ.get('MAX_SERVICES_PER_CLUSTER', '10'))
+# Estimated ECS api calls of a wave, 0 disables the budget. A service deployment costs about
+# ESTIMATED_API_CALLS_PER_SERVICE calls: describe service, describe, list and register task definition and update service
+WAVE_API_BUDGET = int(os.environ.get('WAVE_API_BUDGET', '300'))
+ESTIMATED_API_CALLS_PER_SERVICE = 6
+# Only deploy the services and tasks that are new or changed since the last manifest the state machine applied
+# successfully, kept in RELEASE_BUCKET at MANIFEST_KEY. FORCE_FULL_SYNC, or forceFullSync in the release, deploys every
+# entry again to repair drift
+INCREMENTAL_RELEASES = os.environ.get('INCREMENTAL_RELEASES', 'false').lower() == 'true'
+FORCE_FULL_SYNC = os.environ.get('FORCE_FULL_SYNC', 'false').lower() == 'true'
+MANIFEST_KEY = os.environ.get('MANIFEST_KEY', 'manifests/applied.json')
+PENDING_MANIFEST_PREFIX = 'manifests/pending'
+
 
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    },
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-logging.basicConfig(level=LOG_LEVELS[os.environ.get("LOG_LEVEL", "").lower()])
+logs.setup()
 log = logging.getLogger(__name__)
 
 
+# Retrieve container definitions of many task definitions concurrently, revisions described before are read from the
+# cache
+def retrieve_container_definitions(ecs_client, task_definition_arns):
+    def describe(task_definition_arn):
+        response = task_definitions.describe(ecs_client, task_definition_arn)
+        return response['taskDefinition']['containerDefinitions']
+
+    task_definition_arns = list(task_definition_arns)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return dict(zip(task_definition_arns, executor.map(describe, task_definition_arns)))
+
+
+# Retrieve current task definition of every service, 10 services of a cluster per describe_services call.
+# Returns a dict of (cluster name, service name or arn) -> task definition arn
+def retrieve_service_task_defs(ecs_client, services):
+    by_cluster = collections.defaultdict(list)
+    for service in services:
+        by_cluster[service['clusterName']].append(service['serviceName'])
+    task_def_arns = {}
+    for cluster_name, service_names in by_cluster.items():
+        for key, current_service in ecs_services.describe(ecs_client, cluster_name, service_names).items():
+            task_def_arns[(cluster_name, key)] = current_service['taskDefinition']
+    return task_def_arns
+
+
+# Retrieve current task definitions of all the ECS targets of every scheduled task rule.
+# Returns a dict of rule name -> list of task definition arns
+def retrieve_rule_task_defs(events_client, tasks):
+    def list_targets(cw_rule_name):
+        return list(dict.fromkeys(target['EcsParameters']['TaskDefinitionArn']
+                                  for target in rules.list_ecs_targets(events_client, cw_rule_name)))
+
+    rule_names = list(dict.fromkeys(task['cwRuleName'] for task in tasks))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return dict(zip(rule_names, executor.map(list_targets, rule_names)))
+
+
+# Containers running the image of an entry in the task definitions it uses. Only an entry with a single task definition
+# falls back to its first container, like the deploy task step, task definitions without a container of the entry are
+# left out
+def current_containers(entry, entry_task_def_arns, container_definitions, fallback_to_first):
+    fallback_to_first = fallback_to_first and len(entry_task_def_arns) == 1
+    containers = []
+    for task_def_arn in entry_task_def_arns:
+        container = None
+        if container_definitions.get(task_def_arn):
+            container = task_definitions.find_container(container_definitions[task_def_arn], entry['service'],
+                                                        fallback_to_first)
+        if container is not None:
+            containers.append(container)
+    return containers
+
+
+# Split entries into the ones that need a deployment and the ones whose image is already deployed in every task
+# definition they use, by name or by the digests resolved so far. Entries whose current image can't be determined are
+# kept so the deploy step reports the problem
+def split_unchanged(entries, task_def_arns, container_definitions, fallback_to_first, digests):
+    changed = []
+    unchanged = []
+    for entry, entry_task_def_arns in zip(entries, task_def_arns):
+        containers = current_containers(entry, entry_task_def_arns, container_definitions, fallback_to_first)
+        up_to_date = len(containers) > 0 and all(images.same(container['image'], entry['image'], digests)
+                                                 for container in containers)
+        if up_to_date:
+            unchanged.append(entry)
+        else:
+            changed.append(entry)
+    return changed, unchanged
+
+
+# Split the services and scheduled tasks deployed with one role in one region into changed and unchanged ones
+def plan_pool(assume_role, region, services, tasks, digests):
+    ecs_client = clients.get_client('ecs', assume_role, region)
+    service_task_defs = retrieve_service_task_defs(ecs_client, services)
+    service_arns = [[service_task_defs[(s['clusterName'], s['serviceName'])]]
+                    if (s['clusterName'], s['serviceName']) in service_task_defs else [] for s in services]
+    task_arns = []
+    if tasks:
+        events_client = clients.get_client('events', assume_role, region)
+        rule_task_defs = retrieve_rule_task_defs(events_client, tasks)
+        task_arns = [rule_task_defs.get(t['cwRuleName'], []) for t in tasks]
+    container_definitions = retrieve_container_definitions(
+        ecs_client, {arn for arns in service_arns + task_arns for arn in arns})
+    if images.RESOLVE_IMAGE_DIGESTS:
+        # the current and the deployment tags of a repository are resolved in the same batch_get_image call
+        current_images = [entry['image'] for entry in services + tasks]
+        for entries, arns, fallback_to_first in ((services, service_arns, False), (tasks, task_arns, True)):
+            for entry, entry_task_def_arns in zip(entries, arns):
+                for container in current_containers(entry, entry_task_def_arns, container_definitions,
+                                                    fallback_to_first):
+                    if container['image'] != entry['image']:
+                        current_images.append(container['image'])
+        images.resolve(current_images, assume_role, digests)
+    return (split_unchanged(services, service_arns, container_definitions, False, digests),
+            split_unchanged(tasks, task_arns, container_definitions, True, digests))
+
+
+# Read the currently deployed image of every service and scheduled task in bulk and drop the ones that are already up
+# to date. Every account and region is read in parallel with its own clients. digests holds the image digests resolved
+# so far. Returns the services and tasks to deploy and a summary of the plan
+def plan_release(services, tasks, digests):
+    pools = collections.OrderedDict()
+    for service in services:
+        pools.setdefault((service['assumeRole'], service['region']), ([], []))[0].append(service)
+    for task in tasks or []:
+        pools.setdefault((task['assumeRole'], task['region']), ([], []))[1].append(task)
+
+    unchanged = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(plan_pool, assume_role, region, pool_services, pool_tasks, digests)
+                   for (assume_role, region), (pool_services, pool_tasks) in pools.items()]
+        for future in futures:
+            (_, pool_unchanged_services), (_, pool_unchanged_tasks) = future.result()
+            unchanged.update(id(entry) for entry in pool_unchanged_services + pool_unchanged_tasks)
+
+    # keep the manifest order across pools
+    changed_services = [s for s in services if id(s) not in unchanged]
+    unchanged_services = [s for s in services if id(s) in unchanged]
+    changed_tasks = [t for t in tasks or [] if id(t) not in unchanged]
+    unchanged_tasks = [t for t in tasks or [] if id(t) in unchanged]
+    plan = {
+        'services': len(changed_services),
+        'tasks': len(changed_tasks),
+        'unchangedServiceCount': len(unchanged_services),
+        'unchangedTaskCount': len(unchanged_tasks),
+        'unchangedServices': [s['service'] for s in unchanged_services],
+        'unchangedTasks': [t['service'] for t in unchanged_tasks],
+    }
+    log.info('Release plan: %d of %d services and %d of %d tasks need a deployment', len(changed_services),
+             len(services), len(changed_tasks), len(tasks or []))
+    return changed_services, changed_tasks, plan
+
+
+# Order services so that every service comes after the services it dependsOn, keeping the manifest order otherwise.
+# Dependencies on services that are not part of the release are ignored
+def order_by_dependencies(services):
+    names = {service['service'] for service in services}
+    remaining = list(services)
+    ordered = []
+    done = set()
+    while remaining:
+        ready = [s for s in remaining if all(d in done or d not in names for d in s.get('dependsOn', []))]
+        if not ready:
+            message = 'Circular dependsOn between services: ' + ', '.join(s['service'] for s in remaining)
+            raise Exception(message)
+        ordered.extend(ready)
+        done.update(s['service'] for s in ready)
+        remaining = [s for s in remaining if s['service'] not in done]
+    return ordered
+
+
+# Clusters are told apart by account and region as well as by name
+def cluster_key(service):
+    return service['account'], service['region'], service['clusterName']
+
+
+# Compile the services into ordered deployment waves. Services with a lower priority (default 0) go in earlier waves
+# than services with a higher one, a service goes in a later wave than the services it dependsOn, and a wave holds at
+# most MAX_SERVICES_PER_CLUSTER services of a cluster and WAVE_API_BUDGET estimated api calls. A service can't
+# dependsOn a service with a higher priority, that one would be deployed after it
+def compile_waves(services):
+    priorities = {service['service']: service.get('priority', 0) for service in services}
+    by_priority = collections.defaultdict(list)
+    for service in services:
+        for dependency in service.get('dependsOn', []):
+            if priorities.get(dependency, service.get('priority', 0)) > service.get('priority', 0):
+                message = 'Service ' + service['service'] + ' with priority ' + str(service.get('priority', 0)) + \
+                          ' dependsOn ' + dependency + ' with higher priority ' + str(priorities[dependency]) + \
+                          '. Aborting '
+                raise Exception(message)
+        by_priority[service.get('priority', 0)].append(service)
+
+    waves = []
+    cluster_counts = []
+    wave_of = {}
+    for priority in sorted(by_priority):
+        first_wave = len(waves)
+        for service in order_by_dependencies(by_priority[priority]):
+            wave = max([first_wave] + [wave_of[d] + 1 for d in service.get('dependsOn', []) if d in wave_of])
+            while wave < len(waves) and (
+                    cluster_counts[wave][cluster_key(service)] >= MAX_SERVICES_PER_CLUSTER or
+                    (WAVE_API_BUDGET and (len(waves[wave]) + 1) * ESTIMATED_API_CALLS_PER_SERVICE > WAVE_API_BUDGET)):
+                wave += 1
+            while wave >= len(waves):
+                waves.append([])
+                cluster_counts.append(collections.Counter())
+            waves[wave].append(service)
+            cluster_counts[wave][cluster_key(service)] += 1
+            wave_of[service['service']] = wave
+    log.info('Compiled %d services into %d waves', len(services), len(waves))
+    return waves
+
+
+def normalize(entry):
+    return json.dumps(entry, sort_keys=True, separators=(',', ':'), default=str)
+
+
+# Manifest entries in a stable order, independent of the order in deployment.yaml
+def normalized_manifest(release, services, tasks):
+    return {
+        'release': release,
+        'services': sorted(services, key=normalize),
+        'tasks': sorted(tasks or [], key=normalize),
+    }
+
+
+# Keep the entries of the release that are not in the applied manifest, new entries and entries with any field
+# changed. Returns the services and tasks to deploy and a summary of the diff
+def diff_release(services, tasks, applied):
+    applied_services = {normalize(service) for service in applied.get('services', [])}
+    applied_tasks = {normalize(task) for task in applied.get('tasks', [])}
+    changed_services = [service for service in services if normalize(service) not in applied_services]
+    changed_tasks = [task for task in tasks or [] if normalize(task) not in applied_tasks]
+    diff = {
+        'appliedRelease': applied.get('release'),
+        'services': len(changed_services),
+        'tasks': len(changed_tasks),
+        'skippedServices': len(services) - len(changed_services),
+        'skippedTasks': len(tasks or []) - len(changed_tasks),
+    }
+    log.info('Release diff against %s: %d of %d services and %d of %d tasks are new or changed', diff['appliedRelease'],
+             len(changed_services), len(services), len(changed_tasks), len(tasks or []))
+    return changed_services, changed_tasks, diff
+
+
+# Stamp the release and the role, account and region an entry is deployed with. Entries go to the deployment role of
+# this account and region unless they set an account, whose deployment role has the same name, a region or an
+# assumeRole of their own
+def stamp_target(entry, release):
+    if 'assumeRole' not in entry:
+        if entry.get('account'):
+            entry['assumeRole'] = clients.role_in_account(ECS_DEPLOYMENT_ROLE_ARN, str(entry['account']).zfill(12))
+        else:
+            entry['assumeRole'] = ECS_DEPLOYMENT_ROLE_ARN
+    account = clients.account_of(entry['assumeRole'])
+    if entry.get('account') and str(entry['account']).zfill(12) != account:
+        message = 'Entry ' + entry['service'] + ' sets account ' + str(entry['account']) + ' but assumes role ' + \
+                  entry['assumeRole'] + '. Aborting '
+        raise Exception(message)
+    entry['account'] = account
+    entry['region'] = clients.region_of(entry)
+    entry['release'] = release
+
+
+# Stamp the digest of its image on every entry as imageDigest, resolving the images planning didn't with the role of
+# each entry
+def stamp_digests(entries, digests):
+    by_role = collections.OrderedDict()
+    for entry in entries:
+        by_role.setdefault(entry['assumeRole'], []).append(entry['image'])
+    for assume_role, role_images in by_role.items():
+        images.resolve(role_images, assume_role, digests)
+    for entry in entries:
+        if entry['image'] in digests:
+            entry['imageDigest'] = digests[entry['image']]
+
+
+@metrics.instrumented
 def handler(event, context):
-    log.info("Received event: %s", json.dumps(event))
+    log.info("Received event: %s", logs.lazy_json(event))
     release = event['release']
     log.info(f'Processing items release: {release}')
     tasks = event['tasks']
@@ -41,9 +306,68 @@ def handler(event, context):
     if len(services) == 0:
         message = 'No services found for deployment'
         raise Exception(message)
-    for service in services:
-        service['assumeRole'] = ECS_DEPLOYMENT_ROLE_ARN
-    if tasks:
-        for task in tasks:
-            task['assumeRole'] = ECS_DEPLOYMENT_ROLE_ARN
+    run_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+
+    if INCREMENTAL_RELEASES:
+        # written before the entries are stamped, the state machine copies it to MANIFEST_KEY once the release succeeds
+        pending_key = '%s/%s.json' % (PENDING_MANIFEST_PREFIX, run_id)
+        payloads.write(payloads.RELEASE_BUCKET, pending_key, normalized_manifest(release, services, tasks))
+        event['manifest'] = {
+            'bucket': payloads.RELEASE_BUCKET,
+            'key': MANIFEST_KEY,
+            'copySource': payloads.RELEASE_BUCKET + '/' + pending_key,
+        }
+        if FORCE_FULL_SYNC or event.get('forceFullSync', False):
+            log.info('Full sync requested, deploying every service and task')
+        else:
+            applied = payloads.read(payloads.RELEASE_BUCKET, MANIFEST_KEY)
+            if applied is None:
+                log.info('No applied manifest found, deploying every service and task')
+            else:
+                services, tasks, event['diff'] = diff_release(services, tasks, applied)
+                event['tasks'] = tasks
+
+    for entry in services + (tasks or []):
+        stamp_target(entry, release)
+
+    digests = {}
+    if PRUNE_UNCHANGED:
+        try:
+            services, tasks, plan = plan_release(services, tasks, digests)
+        except Exception as e:
+            # planning is only an optimization, every entry goes through the deploy step when it fails
+            log.warning('Unable to plan release, deploying every service and task: %s', e)
+        else:
+            event['tasks'] = tasks
+            event['plan'] = plan
+    if images.RESOLVE_IMAGE_DIGESTS:
+        stamp_digests(services + (tasks or []), digests)
+
+    # services are deployed wave after wave by the step function
+    event['waves'] = compile_waves(services)
+    del event['services']
+
+    if payloads.OFFLOAD_PAYLOADS:
+        prefix = '%s/%s/%s' % (payloads.PAYLOAD_PREFIX, release, run_id)
+        # chunks hold the entries of a single account and region, so a chunk is deployed with one client pool
+        event['waves'] = [
+            [ref for (account, region), entries in clients.group_by_pool(wave).items()
+             for ref in payloads.offload(prefix, 'services/wave-%03d/%s-%s' % (i, account, region), entries,
+                                         release=release, account=account, region=region)]
+            for i, wave in enumerate(event['waves'])
+        ]
+        if event['tasks']:
+            event['tasks'] = [
+                ref for (account, region), entries in clients.group_by_pool(event['tasks']).items()
+                for ref in payloads.offload(prefix, 'tasks/%s-%s' % (account, region), entries, release=release,
+                                            account=account, region=region)
+            ]
+        if 'plan' in event:
+            # the names of the unchanged entries grow with the release, only their counts stay in the state
+            plan_key = prefix + '/plan.json'
+            payloads.write(payloads.RELEASE_BUCKET, plan_key, event['plan'])
+            event['plan'] = {key: value for key, value in event['plan'].items()
+                             if key not in ('unchangedServices', 'unchangedTasks')}
+            event['plan']['payloadRef'] = {'bucket': payloads.RELEASE_BUCKET, 'key': plan_key}
+        log.info('Release written to s3://%s/%s', payloads.RELEASE_BUCKET, prefix)
     return event
@@ -1,62 +1,48 @@
-import boto3
 import collections
-import json
+import concurrent.futures
 import logging
 import os
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-REGION = os.environ['REGION']
+from deploy_common import clients
+from deploy_common import images
+from deploy_common import logs
+from deploy_common import metrics
+from deploy_common import payloads
+from deploy_common import rules
+from deploy_common import services as ecs_services
+from deploy_common import task_definitions
+
 ACCOUNT_ID = os.environ['ACCOUNT_ID']
-sts_client = boto3.client('sts')
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    },
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-logging.basicConfig(level=LOG_LEVELS[os.environ.get("LOG_LEVEL", "").lower()])
+# put_targets accepts at most 10 targets per call
+PUT_TARGETS_BATCH_SIZE = 10
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+
+logs.setup()
 log = logging.getLogger(__name__)
 
 
-# Retrieve Current Task definition
-def retrieve_task_definition(events_client, cw_rule_name):
-    response = events_client.list_targets_by_rule(
-        Rule=cw_rule_name,
-        Limit=1
-    )
-    targets = response['Targets']
-    target = targets[0]
-    task_definition_arn = target['EcsParameters']['TaskDefinitionArn']
-    log.info('current task definition %s ', task_definition_arn)
-    return task_definition_arn, target
-
-
-# Retrieve Current Image url from current task definition
-def retrieve_current_image(ecs_client, task_definition_arn, service):
-    response = ecs_client.describe_task_definition(
-        taskDefinition=task_definition_arn
-    )
+# Retrieve every ECS target of the scheduled task rule
+def retrieve_targets(events_client, cw_rule_name):
+    targets = rules.list_ecs_targets(events_client, cw_rule_name)
+    if len(targets) == 0:
+        message = 'Couldnt find any ECS target for cw rule: ' + cw_rule_name + '. Aborting '
+        raise Exception(message)
+    log.info('Found %d ECS targets for cw rule %s', len(targets), cw_rule_name)
+    return targets
+
+
+# Retrieve Current Image url from current task definition, revisions described before are read from the cache.
+# The image is None when no container runs an image of service and fallback_to_first is off
+def retrieve_current_image(ecs_client, task_definition_arn, service, fallback_to_first=True):
+    response = task_definitions.describe(ecs_client, task_definition_arn)
     task_definition = response['taskDefinition']
     container_definitions = task_definition['containerDefinitions']
-    log.info(container_definitions)
+    log.debug('Current container definitions: %s', logs.containers(container_definitions), extra=logs.VERBOSE)
     # required if task definition has multiple containers like sidecars
-    container_definition = find_container(container_definitions, service)
+    container_definition = task_definitions.find_container(container_definitions, service, fallback_to_first)
     if container_definition is None:
-        message = 'Couldnt find any image containing ' + service + ' in current taskDefinition ' \
-                  + task_definition_arn + '. Aborting '
-        raise Exception(message)
+        log.info('No image containing %s in current taskDefinition %s', service, task_definition_arn)
+        return None, task_definition
     log.info('Current image definition: %s', container_definition['image'])
     return container_definition['image'], task_definition
 
@@ -65,114 +51,164 @@ def retrieve_current_image(ecs_client, task_definition_arn, service):
 def register_new_task_definition(ecs_client, task_definition, current_image, deployment_image):
     container_definitions = task_definition['containerDefinitions']
     # required if task definition has multiple containers like sidecars
-    container_definition = find_container(container_definitions, current_image)
+    container_definition = task_definitions.find_container(container_definitions, current_image)
     container_definition['image'] = deployment_image
-    log.info('New Task def %s', task_definition)
-    response = ecs_client.register_task_definition(
-        family=task_definition['family'],
-        taskRoleArn=task_definition['taskRoleArn'],
-        executionRoleArn=task_definition['executionRoleArn'],
-        networkMode=task_definition['networkMode'],
-        containerDefinitions=container_definitions,
-        volumes=task_definition['volumes'],
-        placementConstraints=task_definition['placementConstraints'],
-        requiresCompatibilities=task_definition['requiresCompatibilities'],
-        cpu=task_definition['cpu'],
-        memory=task_definition['memory']
-    )
-    new_task_def = response['taskDefinition']['taskDefinitionArn']
+    log.debug('New Task def %s', logs.task_definition(task_definition), extra=logs.VERBOSE)
+    # reuses an existing revision when one with identical content was registered before
+    new_task_def = task_definitions.register(ecs_client, task_definitions.registration_fields(task_definition))
     log.info('New task definition: %s', new_task_def)
     return new_task_def
 
 
-# update cw rules target with the new task definition
-def update_cw_rule_target(events_client, cw_rule_name, target, new_deployment_task_arn):
-    target['EcsParameters']['TaskDefinitionArn'] = new_deployment_task_arn
-    response = events_client.put_targets(
-        Rule=cw_rule_name,
-        Targets=[
-            target
-        ]
-    )
-    log.info('Update Response: %s', response)
-    http_status = response['ResponseMetadata']['HTTPStatusCode']
-    if http_status != 200:
-        message = 'Unable to update target for cw rule: ' + cw_rule_name
-        raise Exception(message)
+# update cw rule targets with their new task definitions, 10 targets per put_targets call
+def update_cw_rule_targets(events_client, cw_rule_name, targets):
+    for chunk in ecs_services.chunks(targets, PUT_TARGETS_BATCH_SIZE):
+        response = events_client.put_targets(
+            Rule=cw_rule_name,
+            Targets=chunk
+        )
+        log.debug('Update Response: %s', logs.lazy_json(response), extra=logs.VERBOSE)
+        http_status = response['ResponseMetadata']['HTTPStatusCode']
+        if http_status != 200 or response.get('FailedEntryCount', 0) > 0:
+            message = 'Unable to update target for cw rule: ' + cw_rule_name + ' ' + str(response.get('FailedEntries'))
+            raise Exception(message)
     return
 
 
-def find_container(containers, service):
-    for x in containers:
-        if service in x['image']:
-            return x
-    # sometimes tasks have different name but are using a same image, so service name doesn't match the image
-    # in this scenario return the first container definition
-    if len(containers) > 0:
-        return containers[0]
-    return None
+# Deploy the image to every target of a scheduled task rule. Each distinct task definition used by the targets is
+# registered only once and all the affected targets are rewritten. previousImage, previousTaskDefArn and
+# deployedTaskDefArn describe the first target, previousTargetTaskDefArns has the previous task definition of every
+# updated target. digests caches the image digests of the invocation
+def deploy_rule(ecs_client, events_client, event, digests=None):
+    service = event['service']
+    deployment_image = event['image']
+    cw_rule_name = event['cwRuleName']
+    digests = {} if digests is None else digests
+
+    # Retrieve Task Definitions
+    log.info('Finding targets of rule of scheduled task cloudwatch rule of %s', cw_rule_name)
+    targets_by_task_def = collections.OrderedDict()
+    for target in retrieve_targets(events_client, cw_rule_name):
+        targets_by_task_def.setdefault(target['EcsParameters']['TaskDefinitionArn'], []).append(target)
+
+    # targets of a rule can run other task families, only the single task definition of a rule falls back to its first
+    # container. Targets whose task definition has no container of the service are left out of the update
+    fallback_to_first = len(targets_by_task_def) == 1
+    current_images = collections.OrderedDict()
+    new_task_defs = {}
+    for current_task_definition_arn in targets_by_task_def:
+        # Get Current Image
+        log.info('Retrieving current image name for service in taskDefinition: %s', current_task_definition_arn)
+        current_image, current_task_definition = retrieve_current_image(ecs_client, current_task_definition_arn,
+                                                                        service, fallback_to_first)
+        if current_image is None:
+            log.info('Skipping targets of %s running another task family', current_task_definition_arn)
+            continue
+        current_images[current_task_definition_arn] = current_image
+        registered_image = images.resolve_entry(event, current_image, digests)
+
+        # compare current image with existing image to check if new deployment is needed
+        log.info('Comparing %s with %s', current_image, deployment_image)
+        if not images.same(current_image, deployment_image, digests):
+            log.info('Creating new Task definition using %s', registered_image)
+            new_task_defs[current_task_definition_arn] = register_new_task_definition(
+                ecs_client, current_task_definition, current_image, registered_image)
+
+    if not current_images:
+        message = 'Couldnt find any image containing ' + service + ' in the task definitions of cw rule ' + \
+                  cw_rule_name + '. Aborting '
+        raise Exception(message)
+
+    updated_targets = []
+    previous_target_task_defs = {}
+    for current_task_definition_arn, new_deployment_task_arn in new_task_defs.items():
+        for target in targets_by_task_def[current_task_definition_arn]:
+            target['EcsParameters']['TaskDefinitionArn'] = new_deployment_task_arn
+            previous_target_task_defs[target['Id']] = current_task_definition_arn
+            updated_targets.append(target)
+    if updated_targets:
+        log.info('Updating %d Cloudwatch event targets of %s with new task definitions', len(updated_targets),
+                 cw_rule_name)
+        update_cw_rule_targets(events_client, cw_rule_name, updated_targets)
+    else:
+        log.info('image matches no new deployment needed')
+
+    first_task_definition_arn = next(iter(current_images))
+    event['previousImage'] = current_images[first_task_definition_arn]
+    event['previousTaskDefArn'] = first_task_definition_arn
+    event['deployedTaskDefArn'] = new_task_defs.get(first_task_definition_arn, first_task_definition_arn)
+    event['deploymentNeeded'] = len(updated_targets) > 0
+    if updated_targets:
+        event['previousTargetTaskDefArns'] = previous_target_task_defs
+    return event
 
 
+@metrics.instrumented
 def handler(event, context):
-    log.info("Received event: %s", json.dumps(event))
-    service = event['service']
-    deployment_image = event['image']
+    log.info("Received event: %s", logs.lazy_json(event))
+    if payloads.is_reference(event):
+        return chunk_handler(event, context)
     assume_role = event['assumeRole']
-    cw_rule_name = event['cwRuleName']
+    region = clients.region_of(event)
 
     # Assume Role
-    log.info('Assuming role : %s', assume_role)
-    assumed_role = sts_client.assume_role(RoleArn=assume_role,
-                                          RoleSessionName="AssumeRoleSession1",
-                                          DurationSeconds=1800)
-    log.info("Successfully assumed role %s", assume_role)
-
-    events_client = boto3.client(
-        'events',
-        region_name=REGION,
-        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-        aws_session_token=assumed_role['Credentials']['SessionToken']
-    )
+    events_client = clients.get_client('events', assume_role, region)
 
     # Describe Service to retrieve Task Definition
-    ecs_client = boto3.client(
-        'ecs',
-        region_name=REGION,
-        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-        aws_session_token=assumed_role['Credentials']['SessionToken']
-    )
-
-    # Retrieve Task Definition
-    log.info('Finding target of rule of scheduled task cloudwatch rule of %s', cw_rule_name)
-    current_task_definition_arn, cw_target = retrieve_task_definition(events_client, cw_rule_name)
-
-    # Get Current Image
-    log.info('Retrieving current image name for service in taskDefinition: %s', current_task_definition_arn)
-    current_image, current_task_definition = retrieve_current_image(ecs_client, current_task_definition_arn,
-                                                                    service)
-
-    # compare current image with existing image to check if new deployment is needed
-    log.info('Comparing %s with %s', current_image, deployment_image)
-    if current_image == deployment_image:
-        log.info('image matches no new deployment needed')
-        event['previousImage'] = current_image
-        event['previousTaskDefArn'] = current_task_definition_arn
-        event['deployedTaskDefArn'] = current_task_definition_arn
-        event['deploymentNeeded'] = False
-    else:
-        log.info('image dos not match new deployment needed')
-        log.info('Creating new Task definition using %s', deployment_image)
-        new_deployment_task_arn = register_new_task_definition(ecs_client, current_task_definition, current_image,
-                                                               deployment_image)
-        log.info('Updating Cloudwatch event target of %s with new task definition %s', cw_rule_name,
-                 new_deployment_task_arn)
-        update_cw_rule_target(events_client, cw_rule_name, cw_target, new_deployment_task_arn)
-        event['previousImage'] = current_image
-        event['previousTaskDefArn'] = current_task_definition_arn
-        event['deployedTaskDefArn'] = new_deployment_task_arn
-        event['deploymentNeeded'] = True
-
-    log.info("Output: %s", json.dumps(event))
+    ecs_client = clients.get_client('ecs', assume_role, region)
+
+    deploy_rule(ecs_client, events_client, event)
+
+    log.info("Output: %s", logs.lazy_json(event))
+    return event
+
+
+# Deploy many scheduled tasks, up to MAX_WORKERS rules at a time. Every entry gets the same fields as handler would
+# add, or an error field if that task failed. Returns the rule names of the failed tasks
+def deploy_tasks(tasks):
+    futures = {}
+    digests = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for task in tasks:
+            events_client = clients.get_client('events', task['assumeRole'], clients.region_of(task))
+            ecs_client = clients.get_client('ecs', task['assumeRole'], clients.region_of(task))
+            futures[executor.submit(deploy_rule, ecs_client, events_client, task, digests)] = task
+
+    for future, task in futures.items():
+        error = future.exception()
+        if error is not None:
+            log.error('Deployment of scheduled task %s failed: %s', task['cwRuleName'], error)
+            task['error'] = str(error)
+
+    failed = [task['cwRuleName'] for task in tasks if 'error' in task]
+    log.info('Processed %d scheduled tasks, %d failed', len(tasks), len(failed))
+    return failed
+
+
+# Deploy many scheduled tasks in one invocation. The event contains a list of task entries in the same shape as
+# handler expects, failed tasks are listed in failedTasks
+@metrics.instrumented
+def batch_handler(event, context):
+    tasks = event['tasks']
+    log.info('Received batch of %d scheduled tasks in %d accounts and regions', len(tasks),
+             len(clients.group_by_pool(tasks)))
+    event['failedTasks'] = deploy_tasks(tasks)
+    return event
+
+
+# Deploy the scheduled tasks of a release chunk stored in S3 and write the results back to it. Tasks deployed by an
+# earlier attempt are not deployed again
+def chunk_handler(event, context):
+    tasks = payloads.load(event)
+    pending = []
+    for task in tasks:
+        task.pop('error', None)
+        if 'deployedTaskDefArn' not in task:
+            pending.append(task)
+    failed = deploy_tasks(pending)
+    payloads.store(event, tasks)
+    if failed:
+        message = 'Deployment failed for scheduled tasks: ' + ', '.join(failed)
+        raise Exception(message)
+    event['deploymentNeeded'] = any(task['deploymentNeeded'] for task in tasks)
     return event
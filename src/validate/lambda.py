@@ -1,109 +1,295 @@
-import boto3
 import collections
-import json
+import concurrent.futures
 import logging
 import os
+import time
+
+from deploy_common import clients
+from deploy_common import logs
+from deploy_common import metrics
+from deploy_common import payloads
+from deploy_common import services as ecs_services
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-REGION = os.environ['REGION']
 ACCOUNT_ID = os.environ['ACCOUNT_ID']
-sts_client = boto3.client('sts')
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    },
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-logging.basicConfig(level=LOG_LEVELS[os.environ.get("LOG_LEVEL", "").lower()])
+# list_tasks returns and describe_tasks accepts at most 100 tasks per call
+LIST_TASKS_PAGE_SIZE = 100
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+MIN_POLL_SECONDS = int(os.environ.get('MIN_POLL_SECONDS', '15'))
+MAX_POLL_SECONDS = int(os.environ.get('MAX_POLL_SECONDS', '180'))
+# roughly the 300 seconds wait plus the 3 exponential retries the step function used before polling
+POLL_TIMEOUT_SECONDS = int(os.environ.get('POLL_TIMEOUT_SECONDS', '2640'))
+# 'deployment' reads the rollout from the deployments describe_services returns, 10 services per call, and only lists
+# and describes the running tasks when that is ambiguous. 'tasks' always checks the running tasks
+VALIDATION_CHECK = os.environ.get('VALIDATION_CHECK', 'deployment').lower()
+# Fail a rollout once its primary deployment has this many failed tasks, 0 waits for the circuit breaker or the timeout
+MAX_FAILED_TASKS = int(os.environ.get('MAX_FAILED_TASKS', '0'))
+
+logs.setup()
 log = logging.getLogger(__name__)
 
 
-# Retrieve Current Tasks
+# Retrieve Current Tasks, yields one page of at most 100 running task arns at a time following nextToken
 def retrieve_current_tasks(ecs_client, cluster_name, service_name):
-    response = ecs_client.list_tasks(
-        cluster=cluster_name,
-        maxResults=100,
-        serviceName=service_name,
-        desiredStatus='RUNNING'
-    )
-    running_tasks = response['taskArns']
-    log.info('Currently running tasks %s', running_tasks)
-    return running_tasks
+    kwargs = {}
+    while True:
+        response = ecs_client.list_tasks(
+            cluster=cluster_name,
+            maxResults=LIST_TASKS_PAGE_SIZE,
+            serviceName=service_name,
+            desiredStatus='RUNNING',
+            **kwargs
+        )
+        running_tasks = response['taskArns']
+        log.debug('Currently running tasks %s', logs.lazy_json(running_tasks), extra=logs.VERBOSE)
+        if running_tasks:
+            yield running_tasks
+        next_token = response.get('nextToken')
+        if not next_token:
+            return
+        kwargs['nextToken'] = next_token
 
 
-# validate if all the running tasks are using new deployed_task_arn This is based on the fact that ECS will only kill
-# older tasks if the new tasks are RUNNING and passing health check with ROLLING DEPLOYMENTS,
-# This is a fail safe mechanism whereby ECS prevents outage by deploying unhealthy tasks
-def validate_running_tasks(ecs_client, cluster_name, running_tasks, service_name, deployed_task_arn):
+# Count the tasks of one page running the deployed task definition and return the first older task definition found
+def count_task_definitions(ecs_client, cluster_name, running_tasks, deployed_task_arn):
     response = ecs_client.describe_tasks(
         cluster=cluster_name,
         tasks=running_tasks,
     )
-    running_tasks_desc = response['tasks']
-    for task in running_tasks_desc:
+    new_tasks = 0
+    old_tasks = 0
+    older_task_arn = None
+    for task in response['tasks']:
         task_arn = task['taskDefinitionArn']
-        if task_arn != deployed_task_arn:
-            message = 'Found older task definition: ' + task_arn + ' still deployed in ecs service: ' + service_name + '. Failing Task. Task will be retried 3 times with exponential delay before marking deployment failed '
+        if task_arn == deployed_task_arn:
+            new_tasks += 1
+        else:
+            old_tasks += 1
+            older_task_arn = older_task_arn or task_arn
+    return new_tasks, old_tasks, older_task_arn
+
+
+# validate if all the running tasks are using new deployed_task_arn This is based on the fact that ECS will only kill
+# older tasks if the new tasks are RUNNING and passing health check with ROLLING DEPLOYMENTS,
+# This is a fail safe mechanism whereby ECS prevents outage by deploying unhealthy tasks.
+# Pages of running tasks are described concurrently while listing continues, and unless stop_at_older is False
+# validation stops at the first task found on an older task definition.
+# Returns the counts of new and old tasks seen, the older task definition if any and whether the rollout is complete
+def validate_running_tasks(ecs_client, cluster_name, service_name, deployed_task_arn, stop_at_older=True):
+    result = {'newTasks': 0, 'oldTasks': 0, 'olderTaskDefArn': None}
+
+    def collect(done):
+        for future in done:
+            new_tasks, old_tasks, older_task_arn = future.result()
+            result['newTasks'] += new_tasks
+            result['oldTasks'] += old_tasks
+            result['olderTaskDefArn'] = result['olderTaskDefArn'] or older_task_arn
+
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for running_tasks in retrieve_current_tasks(ecs_client, cluster_name, service_name):
+            pending.add(executor.submit(count_task_definitions, ecs_client, cluster_name, running_tasks,
+                                        deployed_task_arn))
+            done, pending = concurrent.futures.wait(pending, timeout=0)
+            collect(done)
+            if stop_at_older and result['olderTaskDefArn']:
+                break
+        while pending and not (stop_at_older and result['olderTaskDefArn']):
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+        for future in pending:
+            future.cancel()
+    result['rolloutComplete'] = result['oldTasks'] == 0
+    log.info('Found %d tasks with new and %d tasks with older task definition in ecs service %s',
+             result['newTasks'], result['oldTasks'], service_name)
+    return result
+
+
+# Read the rollout of deployed_task_arn from the deployments of a described service. Returns the same counts as
+# validate_running_tasks, or None when the deployment state is ambiguous: no primary deployment or a primary deployment
+# on another task definition while deployed_task_arn still has a deployment. While the primary deployment of
+# deployed_task_arn is in progress the tasks it still has to start count as old tasks and rolloutComplete stays False.
+# Raises when ECS marked the rollout failed, when the circuit breaker rolled it back, when no deployment of
+# deployed_task_arn is left, or when the primary deployment has MAX_FAILED_TASKS failed tasks
+def rollout_state(service, deployed_task_arn):
+    deployments = service.get('deployments', [])
+    service_name = service['serviceName']
+    # a circuit breaker rollback leaves the failed deployment behind a new primary deployment of the older revision
+    for deployment in deployments:
+        if deployment.get('taskDefinition') == deployed_task_arn and deployment.get('rolloutState') == 'FAILED':
+            message = 'Rollout of task definition ' + deployed_task_arn + ' failed in ecs service: ' + \
+                      service_name + '. ' + deployment.get('rolloutStateReason', '')
+            raise Exception(message)
+    primary = next((d for d in deployments if d.get('status') == 'PRIMARY'), None)
+    if primary is None:
+        return None
+    if primary.get('taskDefinition') != deployed_task_arn:
+        # update_service makes the deployment of deployed_task_arn primary right away, once no deployment of it is
+        # left it was superseded, like by a circuit breaker rollback whose failed deployment went INACTIVE
+        if not any(d.get('taskDefinition') == deployed_task_arn for d in deployments):
+            message = 'Rollout of task definition ' + deployed_task_arn + ' was superseded or rolled back in ecs ' \
+                      'service: ' + service_name + ', primary deployment is on ' + str(primary.get('taskDefinition'))
             raise Exception(message)
-    return
+        return None
+    failed_tasks = primary.get('failedTasks', 0)
+    if MAX_FAILED_TASKS and failed_tasks >= MAX_FAILED_TASKS:
+        message = str(failed_tasks) + ' tasks of task definition ' + deployed_task_arn + ' failed in ecs service: ' + \
+                  service_name + '. Marking deployment failed'
+        raise Exception(message)
 
+    older = [d for d in deployments if d is not primary and d.get('runningCount', 0) > 0]
+    running = primary.get('runningCount', 0)
+    steady = primary.get('rolloutState', 'COMPLETED' if len(deployments) == 1 else None) == 'COMPLETED'
+    result = {
+        'newTasks': running,
+        'oldTasks': sum(d['runningCount'] for d in older) or max(primary.get('desiredCount', 0) - running, 0),
+        'olderTaskDefArn': older[0]['taskDefinition'] if older else None,
+        'rolloutComplete': steady and not older and running >= primary.get('desiredCount', 0),
+    }
+    log.info('Rollout of service %s is %s with %d failed tasks', service_name, primary.get('rolloutState', 'unknown'),
+             failed_tasks)
+    return result
 
-def handler(event, context):
-    log.info("Received event: %s", json.dumps(event))
-    deployment_image = event['image']
-    assume_role = event['assumeRole']
+
+# Check the rollout of the entry's deployed task definition, from the deployment state of its service when
+# VALIDATION_CHECK is 'deployment' and from its running tasks otherwise or when the deployment state is ambiguous.
+# service is the already described service, it is described here when missing
+def check_rollout(ecs_client, event, service=None):
     cluster_name = event['clusterName']
     service_name = event['serviceName']
     deployed_task_arn = event['deployedTaskDefArn']
-    deployment_needed = event['deploymentNeeded']
-    del event['deploymentNeeded']
+    if VALIDATION_CHECK == 'deployment':
+        if service is None:
+            service = ecs_services.describe(ecs_client, cluster_name, [service_name]).get(service_name)
+        result = rollout_state(service, deployed_task_arn) if service is not None else None
+        if result is not None:
+            log.info('Found %d tasks with new and %d tasks with older task definition in ecs service %s deployments',
+                     result['newTasks'], result['oldTasks'], service_name)
+            return result
+        log.info('Deployment state of service %s is ambiguous, checking its running tasks', service_name)
+    return validate_running_tasks(ecs_client, cluster_name, service_name, deployed_task_arn, stop_at_older=False)
+
+
+# Seconds to wait before the next validation. The remaining rollout time is estimated from the share of tasks already
+# running the new task definition and the time spent so far, and the next poll is scheduled half way through it
+def next_poll_interval(progress, elapsed_seconds):
+    if progress <= 0:
+        interval = elapsed_seconds
+    else:
+        interval = elapsed_seconds * (1 - progress) / progress / 2
+    return int(min(MAX_POLL_SECONDS, max(MIN_POLL_SECONDS, interval)))
+
+
+# Describe why the rollout of an entry isn't complete, for the errors raised on it
+def incomplete_rollout(result, event):
+    if result['olderTaskDefArn']:
+        return 'Found older task definition: ' + result['olderTaskDefArn'] + ' still deployed in ecs service: ' + \
+               event['serviceName']
+    return 'Rollout of task definition ' + event['deployedTaskDefArn'] + ' still in progress in ecs service: ' + \
+           event['serviceName']
+
+
+# Poll mode of the validation, never fails while the rollout is progressing. Adds deploymentReady and, while the
+# deployment is not ready, rolloutProgress and nextPollSeconds for the step function to wait on. service is the
+# already described service, if any
+def poll_handler(event, context, service=None):
+    log.info("Received event: %s", logs.lazy_json(event))
+    assume_role = event['assumeRole']
+    service_name = event['serviceName']
 
     # No deployment needed, not validation required
-    if not deployment_needed:
+    if not event['deploymentNeeded']:
         log.info('No deployment needed, not validation required, Marking task successful')
+        del event['deploymentNeeded']
         event['deployed'] = False
-    else:
-        # Assume Role
-        log.info('Assuming role : %s', assume_role)
-        assumed_role = sts_client.assume_role(RoleArn=assume_role,
-                                              RoleSessionName="AssumeRoleSession1",
-                                              DurationSeconds=1800)
-        log.info("Successfully assumed role %s", assume_role)
-
-        # Describe Service to retrieve Task Definition
-        ecs_client = boto3.client(
-            'ecs',
-            region_name=REGION,
-            aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-            aws_session_token=assumed_role['Credentials']['SessionToken']
-        )
+        event['deploymentReady'] = True
+        return event
+
+    now = time.time()
+    started_at = event.setdefault('pollStartedAt', now)
+    event['pollAttempts'] = event.get('pollAttempts', 0) + 1
+    ecs_client = clients.get_client('ecs', assume_role, clients.region_of(event))
+    log.info('Checking rollout progress of service %s, attempt %d', service_name, event['pollAttempts'])
+    result = check_rollout(ecs_client, event, service)
+    event['newTasks'] = result['newTasks']
+    event['oldTasks'] = result['oldTasks']
 
-        # retrieve currently running tasks
-        log.info('Retrieving Currently running tasks for service: %s ', service_name)
-        running_tasks = retrieve_current_tasks(ecs_client, cluster_name, service_name)
-        if len(running_tasks) == 0:
+    if result['rolloutComplete']:
+        del event['deploymentNeeded']
+        event.pop('rolloutProgress', None)
+        event.pop('nextPollSeconds', None)
+        event['deploymentReady'] = True
+        if result['newTasks'] == 0:
             log.warning(
                 'No currently running rasks found, assuming service descaled to 0, adding warning, marking deployment successful')
             event['warning'] = 'No running task found for service :' + service_name
         else:
-            # Validate if the all the RUNNING tasks are from new task arn
-            log.info(
-                'Validating currently running tasks to check if all the tasks are with the new task definition arn')
-            validate_running_tasks(ecs_client, cluster_name, running_tasks, service_name, deployed_task_arn)
             log.info('All running tasks are with new Task Def Arn, Marking deployment successful')
             event['deployed'] = True
+        return event
+
+    elapsed = now - started_at
+    if elapsed >= POLL_TIMEOUT_SECONDS:
+        message = incomplete_rollout(result, event) + ' after ' + str(int(elapsed)) + \
+                  ' seconds. Marking deployment failed'
+        raise Exception(message)
+    total_tasks = result['newTasks'] + result['oldTasks']
+    progress = result['newTasks'] / total_tasks if total_tasks else 0.0
+    event['deploymentReady'] = False
+    event['rolloutProgress'] = round(progress, 2)
+    event['nextPollSeconds'] = next_poll_interval(progress, elapsed)
+    log.info('Rollout of service %s is %d%% done, validating again in %d seconds', service_name, progress * 100,
+             event['nextPollSeconds'])
+    return event
+
 
+# Poll the rollout of every service of a release chunk stored in S3 that isn't ready yet and write the results back.
+# The services are described 10 per call per cluster up front. The chunk is ready once all its services are, until then
+# nextPollSeconds is the shortest wait of its services. Services whose validation failed get a validationError, the
+# rollback step only rolls those back
+def chunk_handler(event, context):
+    services = payloads.load(event)
+    pending = [service for service in services if not service.get('deploymentReady')]
+    for service in pending:
+        service.pop('validationError', None)
+    described = {}
+    if VALIDATION_CHECK == 'deployment':
+        groups = collections.defaultdict(list)
+        for service in pending:
+            if service['deploymentNeeded']:
+                groups[(service['assumeRole'], clients.region_of(service), service['clusterName'])].append(
+                    service['serviceName'])
+        for (assume_role, region, cluster_name), service_names in groups.items():
+            ecs_client = clients.get_client('ecs', assume_role, region)
+            current_services = ecs_services.describe(ecs_client, cluster_name, service_names)
+            for service_name in service_names:
+                described[(assume_role, region, cluster_name, service_name)] = current_services.get(service_name)
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for service in pending:
+            current_service = described.get((service['assumeRole'], clients.region_of(service),
+                                             service['clusterName'], service['serviceName']))
+            futures[executor.submit(poll_handler, service, context, current_service)] = service
+    errors = []
+    for future, service in futures.items():
+        if future.exception() is not None:
+            log.error('Validation of service %s failed: %s', service['serviceName'], future.exception())
+            service['validationError'] = str(future.exception())
+            errors.append(str(future.exception()))
+    payloads.store(event, services)
+    if errors:
+        raise Exception(' '.join(errors))
+
+    waiting = [service for service in services if not service['deploymentReady']]
+    event['deploymentReady'] = len(waiting) == 0
+    if waiting:
+        event['nextPollSeconds'] = min(service['nextPollSeconds'] for service in waiting)
+    else:
+        event.pop('nextPollSeconds', None)
     return event
+
+
+@metrics.instrumented
+def handler(event, context):
+    if payloads.is_reference(event):
+        return chunk_handler(event, context)
+    return poll_handler(event, context)
@@ -0,0 +1,77 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('ACCOUNT_ID', '111111111111')
+os.environ.setdefault('ECS_DEPLOYMENT_ROLE_ARN', 'arn:aws:iam::111111111111:role/ecs-deployment-role')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+
+def load_init():
+    spec = importlib.util.spec_from_file_location('init_lambda', os.path.join(SRC_DIR, 'init', 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+init = load_init()
+
+
+def svc(name, cluster='cluster', **fields):
+    return dict(service=name, clusterName=cluster, serviceName=name + '-svc', account='111111111111',
+                region='us-east-1', **fields)
+
+
+def names(waves):
+    return [[service['service'] for service in wave] for wave in waves]
+
+
+def test_services_without_constraints_share_a_wave():
+    assert names(init.compile_waves([svc('a'), svc('b'), svc('c')])) == [['a', 'b', 'c']]
+
+
+def test_lower_priority_goes_first():
+    waves = init.compile_waves([svc('a', priority=1), svc('b'), svc('c', priority=2)])
+    assert names(waves) == [['b'], ['a'], ['c']]
+
+
+def test_dependency_goes_in_an_earlier_wave():
+    waves = init.compile_waves([svc('api', dependsOn=['db']), svc('db'), svc('web', dependsOn=['api'])])
+    assert names(waves) == [['db'], ['api'], ['web']]
+
+
+def test_dependency_on_lower_priority_is_kept():
+    waves = init.compile_waves([svc('api', priority=1, dependsOn=['db']), svc('db')])
+    assert names(waves) == [['db'], ['api']]
+
+
+def test_dependency_on_higher_priority_fails():
+    with pytest.raises(Exception, match='dependsOn db with higher priority 1'):
+        init.compile_waves([svc('api', dependsOn=['db']), svc('db', priority=1)])
+
+
+def test_dependency_outside_the_release_is_ignored():
+    assert names(init.compile_waves([svc('api', dependsOn=['db'])])) == [['api']]
+
+
+def test_circular_dependency_fails():
+    with pytest.raises(Exception, match='Circular dependsOn'):
+        init.compile_waves([svc('a', dependsOn=['b']), svc('b', dependsOn=['a'])])
+
+
+def test_cluster_limit_splits_waves(monkeypatch):
+    monkeypatch.setattr(init, 'MAX_SERVICES_PER_CLUSTER', 2)
+    waves = init.compile_waves([svc('a'), svc('b'), svc('c'), svc('d', cluster='other')])
+    assert names(waves) == [['a', 'b', 'd'], ['c']]
+
+
+def test_api_budget_splits_waves(monkeypatch):
+    monkeypatch.setattr(init, 'WAVE_API_BUDGET', 2 * init.ESTIMATED_API_CALLS_PER_SERVICE)
+    waves = init.compile_waves([svc('a'), svc('b', cluster='other'), svc('c', cluster='third')])
+    assert names(waves) == [['a', 'b'], ['c']]
@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('ACCOUNT_ID', '111111111111')
+os.environ.setdefault('ECS_DEPLOYMENT_ROLE_ARN', 'arn:aws:iam::111111111111:role/ecs-deployment-role')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+
+def load_init():
+    spec = importlib.util.spec_from_file_location('init_lambda', os.path.join(SRC_DIR, 'init', 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+init = load_init()
+
+
+def svc(name, image='api:1.0.0', **fields):
+    return dict(service=name, clusterName='cluster', serviceName=name + '-svc', image=image, **fields)
+
+
+def task(name, image='job:1.0.0'):
+    return dict(service=name, cwRuleName=name + '-rule', image=image)
+
+
+def applied(services, tasks=None, release='r1'):
+    return init.normalized_manifest(release, services, tasks)
+
+
+def test_unchanged_entries_are_skipped():
+    services, tasks, diff = init.diff_release([svc('a'), svc('b')], [task('j')],
+                                              applied([svc('b'), svc('a')], [task('j')]))
+    assert (services, tasks) == ([], [])
+    assert diff == {'appliedRelease': 'r1', 'services': 0, 'tasks': 0, 'skippedServices': 2, 'skippedTasks': 1}
+
+
+def test_changed_and_new_entries_are_kept():
+    services, tasks, diff = init.diff_release([svc('a', image='api:1.0.1'), svc('b'), svc('c')],
+                                              [task('j', image='job:1.0.1')],
+                                              applied([svc('a'), svc('b')], [task('j')]))
+    assert [service['service'] for service in services] == ['a', 'c']
+    assert [entry['service'] for entry in tasks] == ['j']
+    assert (diff['skippedServices'], diff['skippedTasks']) == (1, 0)
+
+
+def test_any_changed_field_is_a_change():
+    services, _, _ = init.diff_release([svc('a', priority=1)], [], applied([svc('a')]))
+    assert [service['service'] for service in services] == ['a']
+
+
+def test_field_order_is_ignored():
+    entry = dict(reversed(list(svc('a').items())))
+    services, _, _ = init.diff_release([entry], None, applied([svc('a')]))
+    assert services == []
+
+
+def test_without_applied_manifest_everything_is_kept():
+    services, tasks, diff = init.diff_release([svc('a')], None, {})
+    assert ([service['service'] for service in services], tasks) == (['a'], [])
+    assert diff == {'appliedRelease': None, 'services': 1, 'tasks': 0, 'skippedServices': 0, 'skippedTasks': 0}
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+from deploy_common import images  # noqa: E402
+
+REPOSITORY = '111111111111.dkr.ecr.us-east-1.amazonaws.com/team/api'
+DIGEST = 'sha256:' + 'a' * 64
+OTHER_DIGEST = 'sha256:' + 'b' * 64
+
+
+def test_parse_tag():
+    assert images.parse(REPOSITORY + ':1.0.0') == {'registry': '111111111111', 'region': 'us-east-1',
+                                                   'repository': 'team/api', 'tag': '1.0.0', 'digest': None}
+
+
+def test_parse_digest():
+    parsed = images.parse(REPOSITORY + '@' + DIGEST)
+    assert (parsed['repository'], parsed['tag'], parsed['digest']) == ('team/api', None, DIGEST)
+
+
+def test_parse_tag_and_digest():
+    parsed = images.parse(REPOSITORY + ':1.0.0@' + DIGEST)
+    assert (parsed['repository'], parsed['tag'], parsed['digest']) == ('team/api', '1.0.0', DIGEST)
+
+
+def test_parse_china_endpoint():
+    parsed = images.parse('111111111111.dkr.ecr.cn-north-1.amazonaws.com.cn/api:1.0.0')
+    assert (parsed['region'], parsed['repository'], parsed['tag']) == ('cn-north-1', 'api', '1.0.0')
+
+
+@pytest.mark.parametrize('image', [
+    'nginx:1.25',
+    'docker.io/library/nginx:1.25',
+    'ghcr.io/team/api:1.0.0',
+    REPOSITORY + '@sha256:short',
+])
+def test_parse_other_images(image):
+    assert images.parse(image) is None
+
+
+def test_pin_tag():
+    assert images.pin(REPOSITORY + ':1.0.0', DIGEST) == REPOSITORY + '@' + DIGEST
+
+
+def test_pin_untagged():
+    assert images.pin(REPOSITORY, DIGEST) == REPOSITORY + '@' + DIGEST
+
+
+def test_pin_replaces_digest():
+    assert images.pin(REPOSITORY + ':1.0.0@' + OTHER_DIGEST, DIGEST) == REPOSITORY + '@' + DIGEST
+
+
+def test_same_name():
+    assert images.same(REPOSITORY + ':1.0.0', REPOSITORY + ':1.0.0', {})
+
+
+def test_same_resolved_digest():
+    digests = {REPOSITORY + ':1.0.0': DIGEST, REPOSITORY + ':latest': DIGEST}
+    assert images.same(REPOSITORY + ':1.0.0', REPOSITORY + ':latest', digests)
+
+
+def test_same_pinned_digest():
+    assert images.same(REPOSITORY + '@' + DIGEST, REPOSITORY + ':1.0.0', {REPOSITORY + ':1.0.0': DIGEST})
+
+
+def test_different_digests():
+    digests = {REPOSITORY + ':1.0.0': DIGEST, REPOSITORY + ':1.0.1': OTHER_DIGEST}
+    assert not images.same(REPOSITORY + ':1.0.0', REPOSITORY + ':1.0.1', digests)
+
+
+def test_unresolved_images_differ():
+    assert not images.same(REPOSITORY + ':1.0.0', REPOSITORY + ':1.0.1', {})
+    assert not images.same(REPOSITORY + ':1.0.0', REPOSITORY + ':1.0.1', {REPOSITORY + ':1.0.1': DIGEST})
@@ -0,0 +1,51 @@
+import importlib.util
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('ACCOUNT_ID', '111111111111')
+os.environ.setdefault('ECS_DEPLOYMENT_ROLE_ARN', 'arn:aws:iam::111111111111:role/ecs-deployment-role')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+
+def load_deploy():
+    spec = importlib.util.spec_from_file_location('deploy_lambda', os.path.join(SRC_DIR, 'deploy', 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+deploy = load_deploy()
+
+
+def svc(deployment_needed=True, **fields):
+    return dict(service='api', clusterName='cluster', serviceName='api-svc', deploymentNeeded=deployment_needed,
+                **fields)
+
+
+def test_failed_validation_needs_rollback():
+    assert deploy.needs_rollback(svc(deploymentReady=False, validationError='Rollout failed'))
+
+
+def test_caught_deployment_error_needs_rollback():
+    assert deploy.needs_rollback(svc(deploymentError={'Error': 'Exception', 'Cause': 'Rollout failed'}))
+
+
+def test_service_still_rolling_out_is_left_alone():
+    assert not deploy.needs_rollback(svc(deploymentReady=False))
+
+
+def test_ready_service_is_left_alone():
+    assert not deploy.needs_rollback(svc(deploymentReady=True, deploymentError={'Error': 'Exception'}))
+
+
+def test_unchanged_service_is_left_alone():
+    assert not deploy.needs_rollback(svc(deployment_needed=False, validationError='Rollout failed'))
+    assert not deploy.needs_rollback({'service': 'api', 'validationError': 'Rollout failed'})
+
+
+def test_service_rolled_back_before_is_left_alone():
+    assert not deploy.needs_rollback(svc(rolledBack=True, validationError='Rollout failed'))
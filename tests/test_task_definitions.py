@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+from deploy_common import task_definitions  # noqa: E402
+
+ARN = 'arn:aws:ecs:us-east-1:111111111111:task-definition/api:'
+
+
+def task_definition(revision=1, image='api:1.0.0', **fields):
+    return dict(taskDefinitionArn=ARN + str(revision), family='api', revision=revision, status='ACTIVE',
+                containerDefinitions=[{'name': 'api', 'image': image}], **fields)
+
+
+def test_content_hash_ignores_key_order():
+    fields = task_definitions.registration_fields(task_definition(cpu='256', memory='512'))
+    reordered = dict(reversed(list(fields.items())))
+    assert task_definitions.content_hash(fields) == task_definitions.content_hash(reordered)
+
+
+def test_content_hash_changes_with_content():
+    fields = task_definitions.registration_fields(task_definition())
+    changed = task_definitions.registration_fields(task_definition(image='api:1.0.1'))
+    assert task_definitions.content_hash(fields) != task_definitions.content_hash(changed)
+
+
+def test_registration_fields_leave_out_described_fields():
+    fields = task_definitions.registration_fields(task_definition(revision=7, cpu='256', memory=None))
+    assert fields == {'family': 'api', 'containerDefinitions': [{'name': 'api', 'image': 'api:1.0.0'}], 'cpu': '256'}
+
+
+def test_revisions_with_the_same_content_hash_the_same():
+    first = task_definitions.registration_fields(task_definition(revision=1))
+    second = task_definitions.registration_fields(task_definition(revision=2))
+    assert task_definitions.content_hash(first) == task_definitions.content_hash(second)
+
+
+class FakeEcs:
+    def __init__(self):
+        self.calls = 0
+
+    def describe_task_definition(self, taskDefinition, include):
+        self.calls += 1
+        revision = int(taskDefinition.rsplit(':', 1)[1]) if taskDefinition.startswith(ARN) else 1
+        described = task_definition(revision)
+        described['taskDefinitionArn'] = taskDefinition
+        return {'taskDefinition': described, 'tags': []}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    task_definitions.clear_cache()
+    yield monkeypatch
+    task_definitions.clear_cache()
+
+
+def test_described_revisions_are_cached(cache):
+    ecs_client = FakeEcs()
+    task_definitions.describe(ecs_client, ARN + '1')
+    response = task_definitions.describe(ecs_client, ARN + '1', include_tags=True)
+    assert (ecs_client.calls, response['tags']) == (1, [])
+    assert task_definitions.cache_stats() == {'hits': 1, 'misses': 1, 'bytes': task_definitions._cache[ARN + '1'].size,
+                                              'entries': 1}
+
+
+def test_cached_revisions_are_copies(cache):
+    ecs_client = FakeEcs()
+    task_definitions.describe(ecs_client, ARN + '1')['taskDefinition']['containerDefinitions'][0]['image'] = 'changed'
+    response = task_definitions.describe(ecs_client, ARN + '1')
+    assert response['taskDefinition']['containerDefinitions'][0]['image'] == 'api:1.0.0'
+
+
+def test_names_without_revision_are_not_cached(cache):
+    ecs_client = FakeEcs()
+    task_definitions.describe(ecs_client, 'api')
+    task_definitions.describe(ecs_client, 'api')
+    assert (ecs_client.calls, task_definitions.cache_stats()['entries']) == (2, 0)
+
+
+def test_least_recently_used_revision_is_evicted(cache):
+    cache.setattr(task_definitions, 'CACHE_SIZE', 2)
+    ecs_client = FakeEcs()
+    task_definitions.describe(ecs_client, ARN + '1')
+    task_definitions.describe(ecs_client, ARN + '2')
+    task_definitions.describe(ecs_client, ARN + '1')
+    task_definitions.describe(ecs_client, ARN + '3')
+    assert list(task_definitions._cache) == [ARN + '1', ARN + '3']
+    assert task_definitions.cache_stats()['evictions'] == 1
+
+
+def test_revisions_are_evicted_past_cache_bytes(cache):
+    size = len(json.dumps(task_definition(1), separators=(',', ':')))
+    cache.setattr(task_definitions, 'CACHE_BYTES', 2 * size + 1)
+    for revision in (1, 2, 3):
+        task_definitions.cache_put(task_definition(revision))
+    stats = task_definitions.cache_stats()
+    assert list(task_definitions._cache) == [ARN + '2', ARN + '3']
+    assert (stats['bytes'], stats['evictions']) == (2 * size, 1)
+
+
+def test_revision_larger_than_cache_bytes_is_not_cached(cache):
+    cache.setattr(task_definitions, 'CACHE_BYTES', 10)
+    task_definitions.cache_put(task_definition())
+    assert task_definitions.cache_stats()['entries'] == 0
+
+
+def test_put_without_tags_keeps_the_known_tags(cache):
+    tags = [{'key': task_definitions.CONTENT_HASH_TAG, 'value': 'hash'}]
+    task_definitions.cache_put(task_definition(), tags)
+    task_definitions.cache_put(task_definition())
+    assert task_definitions.describe(FakeEcs(), ARN + '1', include_tags=True)['tags'] == tags
@@ -0,0 +1,117 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('ACCOUNT_ID', '111111111111')
+os.environ.setdefault('ECS_DEPLOYMENT_ROLE_ARN', 'arn:aws:iam::111111111111:role/ecs-deployment-role')
+os.environ.setdefault('LOG_LEVEL', 'error')
+sys.path.insert(0, os.path.join(SRC_DIR, 'common'))
+
+NEW = 'arn:aws:ecs:us-east-1:111111111111:task-definition/api:2'
+OLD = 'arn:aws:ecs:us-east-1:111111111111:task-definition/api:1'
+
+
+def load_validate():
+    spec = importlib.util.spec_from_file_location('validate_lambda', os.path.join(SRC_DIR, 'validate', 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+validate = load_validate()
+
+
+def deployment(task_definition, status='ACTIVE', running=0, desired=0, **fields):
+    return dict(taskDefinition=task_definition, status=status, runningCount=running, desiredCount=desired, **fields)
+
+
+def service(*deployments):
+    return {'serviceName': 'api-svc', 'deployments': list(deployments)}
+
+
+def test_completed_primary_is_complete():
+    result = validate.rollout_state(service(deployment(NEW, 'PRIMARY', 3, 3, rolloutState='COMPLETED')), NEW)
+    assert result == {'newTasks': 3, 'oldTasks': 0, 'olderTaskDefArn': None, 'rolloutComplete': True}
+
+
+def test_in_progress_primary_counts_older_tasks():
+    result = validate.rollout_state(service(deployment(NEW, 'PRIMARY', 1, 3, rolloutState='IN_PROGRESS'),
+                                            deployment(OLD, running=2, desired=2)), NEW)
+    assert result == {'newTasks': 1, 'oldTasks': 2, 'olderTaskDefArn': OLD, 'rolloutComplete': False}
+
+
+def test_in_progress_primary_counts_tasks_still_to_start():
+    result = validate.rollout_state(service(deployment(NEW, 'PRIMARY', 1, 3, rolloutState='IN_PROGRESS')), NEW)
+    assert result == {'newTasks': 1, 'oldTasks': 2, 'olderTaskDefArn': None, 'rolloutComplete': False}
+
+
+def test_in_progress_primary_with_all_tasks_running_is_not_complete():
+    result = validate.rollout_state(service(deployment(NEW, 'PRIMARY', 3, 3, rolloutState='IN_PROGRESS'),
+                                            deployment(OLD, desired=0)), NEW)
+    assert result['oldTasks'] == 0
+    assert not result['rolloutComplete']
+
+
+def test_failed_rollout_fails():
+    with pytest.raises(Exception, match='Rollout of task definition .*api:2 failed in ecs service: api-svc'):
+        validate.rollout_state(service(deployment(NEW, 'PRIMARY', 0, 3, rolloutState='FAILED')), NEW)
+
+
+def test_circuit_breaker_rollback_fails():
+    with pytest.raises(Exception, match='failed in ecs service: api-svc. tasks failed to start'):
+        validate.rollout_state(service(deployment(OLD, 'PRIMARY', 3, 3, rolloutState='IN_PROGRESS'),
+                                       deployment(NEW, running=0, rolloutState='FAILED',
+                                                  rolloutStateReason='tasks failed to start')), NEW)
+
+
+def test_missing_primary_is_ambiguous():
+    assert validate.rollout_state(service(deployment(NEW, running=1, desired=3)), NEW) is None
+
+
+def test_other_primary_with_a_deployment_left_is_ambiguous():
+    assert validate.rollout_state(service(deployment(OLD, 'PRIMARY', 3, 3), deployment(NEW, running=1)), NEW) is None
+
+
+def test_other_primary_without_a_deployment_left_fails():
+    with pytest.raises(Exception, match='superseded or rolled back in ecs service: api-svc'):
+        validate.rollout_state(service(deployment(OLD, 'PRIMARY', 3, 3, rolloutState='COMPLETED')), NEW)
+
+
+def test_max_failed_tasks_fails(monkeypatch):
+    monkeypatch.setattr(validate, 'MAX_FAILED_TASKS', 2)
+    with pytest.raises(Exception, match='2 tasks of task definition .*api:2 failed in ecs service: api-svc'):
+        validate.rollout_state(service(deployment(NEW, 'PRIMARY', 1, 3, rolloutState='IN_PROGRESS', failedTasks=2)),
+                               NEW)
+
+
+def test_failed_tasks_are_ignored_without_max_failed_tasks(monkeypatch):
+    monkeypatch.setattr(validate, 'MAX_FAILED_TASKS', 0)
+    result = validate.rollout_state(service(deployment(NEW, 'PRIMARY', 1, 3, rolloutState='IN_PROGRESS',
+                                                       failedTasks=5)), NEW)
+    assert result['newTasks'] == 1
+
+
+def test_next_poll_interval_waits_half_the_remaining_time(monkeypatch):
+    monkeypatch.setattr(validate, 'MIN_POLL_SECONDS', 15)
+    monkeypatch.setattr(validate, 'MAX_POLL_SECONDS', 180)
+    # a quarter of the tasks in 40 seconds leaves about 120 seconds
+    assert validate.next_poll_interval(0.25, 40) == 60
+
+
+def test_next_poll_interval_without_progress_waits_the_elapsed_time(monkeypatch):
+    monkeypatch.setattr(validate, 'MIN_POLL_SECONDS', 15)
+    monkeypatch.setattr(validate, 'MAX_POLL_SECONDS', 180)
+    assert validate.next_poll_interval(0, 30) == 30
+
+
+def test_next_poll_interval_is_bounded(monkeypatch):
+    monkeypatch.setattr(validate, 'MIN_POLL_SECONDS', 15)
+    monkeypatch.setattr(validate, 'MAX_POLL_SECONDS', 180)
+    assert validate.next_poll_interval(0.9, 10) == 15
+    assert validate.next_poll_interval(0.01, 600) == 180
+    assert validate.next_poll_interval(0, 0) == 15